@@ -0,0 +1,441 @@
+'''
+bench.py
+Times the decode/resize/encode pipeline on a synthetic corpus.
+
+    python benchmarks/bench.py [--full] [--out results.json]
+    python benchmarks/bench.py --baseline results.json [--tolerance 0.1]
+    python benchmarks/bench.py --backends
+
+Each stage runs in its own process, against the real mercury code, so its
+peak RSS can be told apart from the others:
+    dispatch        dispatch() header read, hashing and archive move
+    ipc-pickle      img_pickle/img_unpickle round trip through cPickle
+    resize-WxH      ResizeWorker open, draft and thumbnail for one tier
+    resize-cascade  CascadeResizeWorker producing every tier from one decode
+    encode          img_encode of the largest tier in the source format
+    end-to-end      the whole pipeline with stub services, many files at once
+
+With --backends the resize stage is instead run at the middle tier once for
+every resize backend installed and resample filter, as resize-BACKEND-FILTER,
+and the fastest backend is reported as the one to set resize_backend to.
+
+Results are printed and written as JSON. With --baseline the run is compared
+against an earlier one and exits non-zero if a stage's throughput or median
+latency got worse by more than the tolerance.
+'''
+from __future__ import print_function
+
+import argparse
+import cPickle
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PIL
+from PIL import Image
+
+import corpus
+import mercury.database
+import mercury.dispatcher
+import mercury.services
+
+# The pipeline logs at debug to a file by default, which would be timed too
+logging.getLogger('mercury').setLevel(logging.WARNING)
+
+TIERS = ((2048, 2048), (1280, 1280), (640, 640))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lower = int(k)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (k - lower)
+
+
+def summarize(durations, elapsed=None, peak_rss=None):
+    '''Turn per image durations, in seconds, into a result. elapsed is the
+    wall time for stages where images overlap.'''
+    if elapsed is None:
+        elapsed = sum(durations)
+    return {
+        'images': len(durations),
+        'images_per_sec': len(durations) / elapsed if elapsed else None,
+        'p50_ms': percentile(durations, 50) * 1000 if durations else None,
+        'p99_ms': percentile(durations, 99) * 1000 if durations else None,
+        'peak_rss_kb': peak_rss,
+    }
+
+
+def _peak_rss():
+    # Kilobytes on Linux, bytes on OS X
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def isolated(fn, *args):
+    '''Run fn(*args) in a fresh process and return its result with the
+    process' peak RSS added.'''
+    results = multiprocessing.Queue()
+
+    def run():
+        try:
+            result = fn(*args)
+            result['peak_rss_kb'] = max(result.get('peak_rss_kb') or 0, _peak_rss())
+            results.put(result)
+        except Exception as e:
+            results.put({'error': repr(e)})
+            raise
+
+    p = multiprocessing.Process(target=run)
+    p.start()
+    result = results.get()
+    p.join()
+    return result
+
+
+def _config(root, services):
+    watched = os.path.join(root, 'watched')
+    archive = os.path.join(watched, 'archive')
+    for d in (watched, archive):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    config = {
+        'watched_folder': watched,
+        'archive_folder': archive,
+        'database_file': os.path.join(root, 'bench.sqlite'),
+        'tmp': tempfile.mkdtemp(dir=root),
+        'services': services,
+    }
+    config['db'] = mercury.database.db(config)
+    return config
+
+
+def bench_dispatch(entries, root, repeat):
+    config = _config(root, {})
+    durations = []
+    for i in range(repeat):
+        for e in entries:
+            path = os.path.join(config['watched_folder'], '%i-%s' % (i, os.path.basename(e['path'])))
+            shutil.copy(e['path'], path)
+            start = time.time()
+            mercury.dispatcher.dispatch(config, path)
+            durations.append(time.time() - start)
+    return summarize(durations)
+
+
+def bench_pickle(entries, repeat):
+    durations = []
+    for e in entries:
+        image = Image.open(e['path'])
+        image.load()
+        for i in range(repeat):
+            start = time.time()
+            data = cPickle.dumps(mercury.dispatcher.img_pickle(image), 2)
+            mercury.dispatcher.img_unpickle(cPickle.loads(data)).load()
+            durations.append(time.time() - start)
+            del data
+    return summarize(durations)
+
+
+def _resizer(cls, config, *args):
+    # A worker object without its process, run in this one
+    worker = cls.__new__(cls)
+    worker._config = config
+    worker._backend = mercury.dispatcher.resize_backend(config)
+    if cls is mercury.dispatcher.CascadeResizeWorker:
+        profiles = args[0]
+        worker._tiers = [(mercury.dispatcher.normalize_size(p[0]), profiles[p], p[1], p[2]) for p in profiles]
+        worker._services = [s for p in profiles for s in profiles[p]]
+    else:
+        worker._size = mercury.dispatcher.normalize_size(args[0])
+        worker._services = args[1]
+        worker._resample = args[2]
+        worker._reducing_gap = args[3]
+    worker._profiles = dict((s, mercury.dispatcher.encode_profile(config, s)) for s in worker._services)
+    # Encoding is timed on its own, but it's what would decode an image
+    # that needed no resizing, so do that much
+    worker._push = lambda job, services: worker._image.load()
+    return worker
+
+
+def bench_resize(entries, root, repeat, tier, backend='pillow', resample='lanczos'):
+    config = _config(root, {'bench': None})
+    config['resize_backend'] = backend
+    worker = _resizer(mercury.dispatcher.ResizeWorker, config, tier, ['bench'], resample, None)
+    result = _run_resizer(worker, entries, repeat)
+    result['backend'] = worker._backend.name
+    return result
+
+
+def bench_cascade(entries, root, repeat):
+    config = _config(root, dict(('bench-%i' % t[0], None) for t in TIERS))
+    profiles = dict(((t, 'lanczos', None), ['bench-%i' % t[0]]) for t in TIERS)
+    worker = _resizer(mercury.dispatcher.CascadeResizeWorker, config, profiles)
+    return _run_resizer(worker, entries, repeat)
+
+
+def _run_resizer(worker, entries, repeat):
+    durations = []
+    for e in entries:
+        job = {'file': e['path'], 'format': e['format'], 'cost': 0,
+               'services': worker._services, 'hash': None, 'phash': None}
+        for i in range(repeat):
+            worker._format = e['format']
+            start = time.time()
+            worker._resize(job, worker._services)
+            durations.append(time.time() - start)
+            worker._image = None
+    return summarize(durations)
+
+
+def bench_encode(entries, repeat):
+    durations = []
+    for e in entries:
+        image = Image.open(e['path'])
+        image.thumbnail(TIERS[0], Image.ANTIALIAS)
+        for i in range(repeat):
+            start = time.time()
+            mercury.dispatcher.img_encode(image, e['format'])
+            durations.append(time.time() - start)
+    return summarize(durations)
+
+
+class _Stub(object):
+    '''Stands in for a service, noting when each file finished uploading.'''
+    formats = ('JPEG', 'PNG', 'GIF')
+    finished = {}
+    lock = threading.Lock()
+
+    @classmethod
+    def upload(cls, config, path, *args, **kwargs):
+        return cls._done(path)
+
+    @classmethod
+    def upload_bytes(cls, config, buf, format, *args, **kwargs):
+        buf.read()
+        return cls._done(None)
+
+    @classmethod
+    def _done(cls, path):
+        # The job isn't passed to services, so the stubs are fed one file
+        # name per upload through the thread that's handling it
+        name = threading.current_thread().bench_file
+        with cls.lock:
+            cls.finished[name] = time.time()
+        return {'ok': True}
+
+
+def bench_end_to_end(entries, root, repeat):
+    services = dict(('bench-%i' % t[0], {'xres': t[0], 'yres': t[1], 'concurrency': 2}) for t in TIERS)
+    for name in services:
+        mercury.services.registry[name] = _Stub
+    config = _config(root, services)
+    config['dedup'] = False
+
+    # Let the stubs know which file an upload belongs to
+    handle = mercury.dispatcher.UploadWorker.handle
+
+    def tagged(self, item):
+        threading.current_thread().bench_file = os.path.basename(item.job['file'])
+        return handle(self, item)
+    mercury.dispatcher.UploadWorker.handle = tagged
+
+    mercury.dispatcher.setup_resize_workers(config)
+    mercury.dispatcher.setup_upload_workers(config)
+    mercury.dispatcher.setup_dispatch_workers(config)
+
+    paths = []
+    for i in range(repeat):
+        for e in entries:
+            path = os.path.join(config['watched_folder'], '%i-%s' % (i, os.path.basename(e['path'])))
+            shutil.copy(e['path'], path)
+            paths.append(path)
+
+    peak = [0]
+    stop = threading.Event()
+    sampler = threading.Thread(target=_sample_rss, args=(peak, stop))
+    sampler.daemon = True
+    sampler.start()
+
+    submitted = {}
+    start = time.time()
+    for path in paths:
+        submitted[os.path.basename(path)] = time.time()
+        mercury.dispatcher.dispatchworkers.put(path)
+    workers = mercury.dispatcher.dispatchworkers
+    while workers.queue.unfinished_tasks or mercury.dispatcher.pending.count:
+        time.sleep(0.01)
+    elapsed = time.time() - start
+    stop.set()
+
+    durations = [_Stub.finished[name] - submitted[name] for name in submitted if name in _Stub.finished]
+    return summarize(durations, elapsed, peak[0] or None)
+
+
+def _sample_rss(peak, stop):
+    '''Track the combined RSS of this process and its resize workers.'''
+    while not stop.is_set():
+        total = 0
+        for pid in [os.getpid()] + [p.pid for p in multiprocessing.active_children()]:
+            try:
+                with open('/proc/%i/status' % pid) as f:
+                    for line in f:
+                        if line.startswith('VmRSS:'):
+                            total += int(line.split()[1])
+            except IOError:
+                pass
+        peak[0] = max(peak[0], total)
+        stop.wait(0.05)
+
+
+def run(entries, root, repeat):
+    stages = [
+        ('dispatch', bench_dispatch, (entries, os.path.join(root, 'dispatch'), repeat)),
+        ('ipc-pickle', bench_pickle, (entries, repeat)),
+    ]
+    for tier in TIERS:
+        stages.append(('resize-%ix%i' % tier, bench_resize, (entries, os.path.join(root, 'resize'), repeat, tier)))
+    stages += [
+        ('resize-cascade', bench_cascade, (entries, os.path.join(root, 'cascade'), repeat)),
+        ('encode', bench_encode, (entries, repeat)),
+        ('end-to-end', bench_end_to_end, (entries, os.path.join(root, 'e2e'), repeat)),
+    ]
+    results = {}
+    for name, fn, args in stages:
+        print('%-16s' % name, end='')
+        sys.stdout.flush()
+        results[name] = isolated(fn, *args)
+        print(_line(results[name]))
+    return results
+
+
+def run_backends(entries, root, repeat):
+    results = {}
+    for backend in sorted(mercury.dispatcher.backends):
+        for resample in mercury.dispatcher.RESAMPLE:
+            name = 'resize-%s-%s' % (backend, resample)
+            print('%-24s' % name, end='')
+            sys.stdout.flush()
+            results[name] = isolated(bench_resize, entries, os.path.join(root, name), repeat,
+                                     TIERS[1], backend, resample)
+            print(_line(results[name]))
+    return results
+
+
+def fastest_backend(results):
+    '''Return the backend with the best throughput summed over every resample
+    filter, and print how each one did.'''
+    totals = {}
+    for name, result in results.items():
+        if 'error' in result:
+            continue
+        backend = name.split('-')[1]
+        totals[backend] = totals.get(backend, 0) + (result['images_per_sec'] or 0)
+    if not totals:
+        return None
+    fastest = max(totals, key=totals.get)
+    print('\nFastest resize backend: %s (set resize_backend: %s)' % (
+        results['resize-%s-lanczos' % fastest].get('backend', fastest), fastest))
+    return fastest
+
+
+def _line(result):
+    if 'error' in result:
+        return 'failed: %s' % result['error']
+    return '%8.2f img/s  p50 %9.1fms  p99 %9.1fms  peak %8i KB' % (
+        result['images_per_sec'] or 0, result['p50_ms'] or 0, result['p99_ms'] or 0,
+        result['peak_rss_kb'] or 0)
+
+
+def compare(results, baseline, tolerance):
+    '''Print how results moved against baseline and return the stages that
+    regressed by more than tolerance.'''
+    regressions = []
+    print('\n%-16s %12s %12s' % ('vs baseline', 'img/s', 'p50'))
+    for name in sorted(results):
+        if name not in baseline or 'error' in results[name] or 'error' in baseline[name]:
+            continue
+        new, old = results[name], baseline[name]
+        speed = new['images_per_sec'] / old['images_per_sec'] - 1 if old['images_per_sec'] else 0
+        latency = new['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0
+        flag = ''
+        if speed < -tolerance or latency > tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-16s %+11.1f%% %+11.1f%%%s' % (name, speed * 100, latency * 100, flag))
+    return regressions
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark the mercury image pipeline.')
+    parser.add_argument('--full', action='store_true', help='include 24 and 50 MP images')
+    parser.add_argument('--repeat', type=int, default=3, help='times each image goes through a stage')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--corpus', help='keep the generated corpus here and reuse it')
+    parser.add_argument('--out', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare against results from an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='fraction a stage may slow down before it counts as a regression')
+    parser.add_argument('--backends', action='store_true',
+                        help='compare the installed resize backends and filters instead')
+    args = parser.parse_args(args)
+
+    root = tempfile.mkdtemp(prefix='mercury-bench-')
+    try:
+        corpus_dir = args.corpus or os.path.join(root, 'corpus')
+        sizes = corpus.FULL_SIZES if args.full else corpus.QUICK_SIZES
+        print('Building corpus in %s' % corpus_dir)
+        # In its own process so the stages don't inherit its memory
+        entries = isolated(lambda: {'entries': corpus.build(corpus_dir, sizes, args.seed)})['entries']
+        if args.backends:
+            results = run_backends(entries, root, args.repeat)
+        else:
+            results = run(entries, root, args.repeat)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pillow': getattr(PIL, '__version__', getattr(PIL, 'PILLOW_VERSION', None)),
+            'platform': platform.platform(),
+            'cpus': multiprocessing.cpu_count(),
+            'sizes': list(sizes),
+            'seed': args.seed,
+            'repeat': args.repeat,
+        },
+        'stages': results,
+    }
+    if args.backends:
+        report['fastest_backend'] = fastest_backend(results)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Wrote %s' % args.out)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['stages'], args.tolerance)
+        if regressions:
+            print('Regressed: %s' % ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,77 @@
+'''
+corpus.py
+Deterministic synthetic images for the benchmarks. Every image is grown from
+a small seeded noise tile, so the same seed and size always give the same
+pixels, and the smooth result compresses roughly like a photo would.
+'''
+import json
+import os
+import random
+
+from PIL import Image
+
+# (format, mode) pairs covered by the corpus
+KINDS = (
+    ('JPEG', 'RGB'),
+    ('JPEG', 'L'),
+    ('JPEG', 'CMYK'),
+    ('PNG', 'RGB'),
+    ('PNG', 'RGBA'),
+    ('PNG', 'L'),
+    ('GIF', 'P'),
+)
+
+# Megapixels
+QUICK_SIZES = (0.3, 2, 12)
+FULL_SIZES = (0.3, 2, 12, 24, 50)
+
+_EXTENSIONS = {'JPEG': 'jpg', 'PNG': 'png', 'GIF': 'gif'}
+
+
+def dimensions(megapixels):
+    '''Return a 3:2 (width, height) close to megapixels.'''
+    height = int(round((megapixels * 1e6 / 1.5) ** 0.5))
+    return (int(round(height * 1.5)), height)
+
+
+def synthesize(size, mode, seed):
+    '''Return a deterministic image of size in mode.'''
+    rng = random.Random(seed)
+    tile = Image.frombytes('RGB', (24, 16), bytes(bytearray(rng.randint(0, 255) for i in range(24 * 16 * 3))))
+    image = tile.resize(size, Image.BICUBIC)
+    if mode == 'RGBA':
+        alpha = tile.convert('L').transpose(Image.FLIP_LEFT_RIGHT).resize(size, Image.BICUBIC)
+        image.putalpha(alpha)
+        return image
+    if mode == 'P':
+        return image.convert('P', palette=Image.ADAPTIVE, colors=256)
+    return image.convert(mode)
+
+
+def build(directory, sizes=QUICK_SIZES, seed=1):
+    '''
+    Write the corpus into directory and return the list of entries, each a
+    dict with path, format, mode and megapixels. A corpus already there with
+    the same sizes and seed is reused as is.
+    '''
+    manifest = os.path.join(directory, 'manifest.json')
+    spec = {'sizes': list(sizes), 'seed': seed}
+    if os.path.exists(manifest):
+        with open(manifest) as f:
+            existing = json.load(f)
+        if existing['spec'] == spec and all(os.path.exists(e['path']) for e in existing['entries']):
+            return existing['entries']
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    entries = []
+    for n, (format, mode) in enumerate(KINDS):
+        for megapixels in sizes:
+            path = os.path.join(directory, '%s-%s-%gmp.%s' % (
+                format.lower(), mode.lower(), megapixels, _EXTENSIONS[format]))
+            image = synthesize(dimensions(megapixels), mode, seed * 1000 + n)
+            image.save(path, format)
+            entries.append({'path': path, 'format': format, 'mode': mode, 'megapixels': megapixels})
+    with open(manifest, 'w') as f:
+        json.dump({'spec': spec, 'entries': entries}, f, indent=2)
+    return entries
@@ -1,29 +1,42 @@
 #!/usr/bin/env python
 
+import argparse
+import os
 import shutil
 import sys
 import tempfile
 
+import mercury.backfill
 import mercury.config
 import mercury.database
 import mercury.dispatcher
 import mercury.log
+import mercury.metrics
 import mercury.services
+import mercury.sessions
 import mercury.watcher
 
 _configFile = 'config.yaml'
 _tmp = None
+_journal = None
 
 log = mercury.log.getLogger()
 log.info('Initializing project')
 
 
 def main(args):
-    global _tmp
+    global _tmp, _journal
+    parser = argparse.ArgumentParser(description='Prep and upload images to hosting services.')
+    parser.add_argument(
+        '--backfill', metavar='DIR',
+        help='upload every image under DIR where it is, then exit instead of watching')
+    args = parser.parse_args(args)
+
     config = mercury.config.getConfig(_configFile)
     if not config:
         log.critical('Invalid config.')
         sys.exit(1)
+    mercury.log.setup(config)
 
     # Initialize tmp directory
     _tmp = tempfile.mkdtemp()
@@ -33,6 +46,9 @@ def main(args):
     db = mercury.database.db(config)
     config['db'] = db
     # TODO threading safety?
+    if 'job_journal' not in config or config['job_journal'] is not False:
+        _journal = mercury.database.Journal(db)
+        config['journal'] = _journal
 
     # Initialize services
     for s in mercury.services.registry:
@@ -41,18 +57,42 @@ def main(args):
         if new_config:
             config = new_config
 
+    # Before the resize workers fork so they know to report back
+    mercury.metrics.setup(config)
     mercury.dispatcher.setup_resize_workers(config)
     mercury.dispatcher.setup_upload_workers(config)
+    mercury.dispatcher.setup_dispatch_workers(config)
+    mercury.dispatcher.replay(config)
+
+    if args.backfill:
+        mercury.backfill.run(config, args.backfill)
+        return
+
+    # Pick up anything that landed while we weren't watching
+    if 'scan_on_startup' in config and config['scan_on_startup']:
+        for folder in mercury.watcher.watched(config):
+            if os.path.isdir(folder):
+                mercury.backfill.queue(config, folder, recursive=False)
+
     mercury.watcher.startWatcher(config, config['watched_folder'], config['check_interval'])
 
 
+def cleanup():
+    # Commit whatever the journal has queued so replay starts from it
+    if _journal:
+        _journal.flush()
+    mercury.sessions.close()
+    try:
+        shutil.rmtree(_tmp)
+    except TypeError:
+        pass  # Probably a None from no tmp being created.
+
+
 if __name__ == '__main__':
     try:
         main(sys.argv[1:])
     except KeyboardInterrupt:
-        try:
-            shutil.rmtree(_tmp)
-        except TypeError:
-            pass  # Probably a None from no tmp being created.
+        cleanup()
         log.warning('Caught keyboard interrupt. Closing.')
         sys.exit(1)
+    cleanup()
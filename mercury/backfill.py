@@ -0,0 +1,105 @@
+'''
+backfill.py
+Feeds files that already exist through the pipeline, either as a one-shot
+bulk run or to catch up on files that arrived while mercury wasn't running.
+
+A bulk run uploads files from where they are, leaving the folder as it was.
+Catching up treats files like any other arriving in the watched folder and
+moves them into the archive.
+'''
+from __future__ import print_function
+
+import os
+import time
+
+import mercury.dispatcher
+import mercury.log
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+log = mercury.log.getLogger()
+
+
+def scan(config, path, recursive=True):
+    '''Yield every file under path, leaving out the archive folder and our
+    own database so they aren't fed back in.'''
+    skip = set()
+    if 'archive_folder' in config and config['archive_folder']:
+        skip.add(os.path.abspath(config['archive_folder']))
+    stack = [os.path.abspath(path)]
+    while stack:
+        directory = stack.pop()
+        for name, is_dir in _entries(directory):
+            full = os.path.join(directory, name)
+            if is_dir:
+                if recursive and full not in skip:
+                    stack.append(full)
+            elif not name.endswith(('.sqlite', 'sqlite-journal', 'sqlite-wal', 'sqlite-shm')):
+                yield full
+
+
+def _entries(directory):
+    # scandir gets file types from the directory listing itself, saving a
+    # stat per file on big trees
+    try:
+        if scandir:
+            return [(e.name, e.is_dir(follow_symlinks=False)) for e in scandir(directory)]
+        return [(n, os.path.isdir(os.path.join(directory, n)) and
+                 not os.path.islink(os.path.join(directory, n)))
+                for n in os.listdir(directory)]
+    except OSError:
+        log.warning('Unable to list %s', directory)
+        return []
+
+
+def queue(config, path, recursive=True, archive=True):
+    '''Hand every file under path to the dispatch workers without waiting,
+    to be archived or left in place. Returns the number of files queued.'''
+    count = 0
+    for f in scan(config, path, recursive):
+        mercury.dispatcher.dispatchworkers.put(f, archive)
+        count += 1
+    log.info('Queued %i existing file(s) from %s', count, path)
+    return count
+
+
+def run(config, path, interval=5):
+    '''Push every file under path through the pipeline at full parallelism,
+    leaving the files in place, and return once everything has been
+    uploaded, reporting progress every interval seconds.'''
+    start = time.time()
+    total = queue(config, path, archive=False)
+    print('Backfilling %i file(s) from %s' % (total, path))
+
+    workers = mercury.dispatcher.dispatchworkers
+    reported = start
+    while True:
+        time.sleep(0.5)
+        # Dispatch adds its items to pending before it's marked done, so both
+        # hitting zero together means the pipeline is empty
+        waiting = workers.queue.unfinished_tasks
+        items = mercury.dispatcher.pending.count
+        if not waiting and not items:
+            break
+        if time.time() - reported >= interval:
+            _report(start, total, total - waiting, items)
+            reported = time.time()
+
+    elapsed = time.time() - start
+    print('Backfill of %i file(s) finished in %.1fs (%.2f files/s)' % (
+        total, elapsed, total / elapsed if elapsed else 0))
+    log.info('Backfill of %s finished in %.1fs', path, elapsed)
+
+
+def _report(start, total, dispatched, items):
+    elapsed = time.time() - start
+    line = '%i/%i file(s) dispatched, %i item(s) resizing or uploading, %.2f files/s' % (
+        dispatched, total, items, dispatched / elapsed if elapsed else 0)
+    print(line)
+    log.info('Backfill: %s', line)
@@ -14,7 +14,7 @@ log = mercury.log.getLogger()
 
 def getConfig(file):
     '''Parses given file and returns a config dictionary'''
-    log.debug('Config File: %s' % file)
+    log.debug('Config File: %s', file)
     try:
         with open(file) as c:
             config = yaml.safe_load(c)
@@ -33,7 +33,7 @@ def getConfig(file):
     except yaml.scanner.ScannerError:  # bad yaml
             log.error('Malformed YAML')
             return None
-    log.debug('Config values: %s' % config)
+    log.debug('Config values: %s', config)
     return validate(config)
 
 
@@ -50,7 +50,7 @@ def validate(config):
                 if e.errno == errno.EEXIST:
                     log.error('Watch path is a file.')
                     return None
-            log.info('Created watch directory at %s' % path)
+            log.info('Created watch directory at %s', path)
     except TypeError:
         log.error('Watch folder path must be specified!')
         return None
@@ -68,7 +68,7 @@ def validate(config):
             if e.errno == errno.EEXIST:
                 log.error('Archive path is a file.')
                 return None
-        log.info('Created archive directory at %s' % path)
+        log.info('Created archive directory at %s', path)
     return config
 
 
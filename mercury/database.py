@@ -1,5 +1,7 @@
+import Queue
 import sqlite3
 import os
+import threading
 
 import mercury.log
 
@@ -7,19 +9,31 @@ log = mercury.log.getLogger()
 
 
 class db(object):
+    '''
+    The sqlite database. Each thread gets one connection, opened on first use
+    and kept for the life of the thread, in WAL mode so readers don't block
+    the journal writer. Service credentials go through get_token and
+    set_token, which keep a copy in memory so they only hit the disk once.
+    '''
+    # Bumped whenever _migrate learns a new step
+    _version = 3
+
     def __init__(self, config):
         if not config['database_file']:
             self._file = os.path.abspath(os.path.expanduser(config['watched_folder'])) + \
                 '/mercury.sqlite'
         else:
             self._file = os.path.abspath(os.path.expanduser(config['database_file']))
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._service_ids = {}
         try:
-            self._db = sqlite3.connect(self._file)
+            con = self.connect()
         except sqlite3.OperationalError:
             log.error('Unable to open database!')
             raise
-        con = sqlite3.connect(self._file)
-        try:
+        with con:
             con.execute(
                 '''
                 create table if not exists services (
@@ -34,8 +48,281 @@ class db(object):
                     service_id   integer not null,
                     foreign key(service_id) references services(service_id)
                     ) ''')
-        finally:
-            con.close()
+            con.execute(
+                '''
+                create table if not exists uploads (
+                    content_hash  text not null,
+                    service_name  text not null,
+                    phash         integer,
+                    result        text,
+                    uploaded      timestamp default current_timestamp,
+                    primary key (content_hash, service_name)
+                    ) ''')
+            con.execute(
+                '''
+                create table if not exists jobs (
+                    file          text not null,
+                    service_name  text not null,
+                    stage         text not null,
+                    format        text,
+                    content_hash  text,
+                    phash         text,
+                    passthrough   integer not null default 0,
+                    source        text,
+                    updated       timestamp default current_timestamp,
+                    primary key (file, service_name)
+                    ) ''')
+        self._migrate(con)
 
     def connect(self):
-        return sqlite3.connect(self._file)
+        '''Return this thread's connection. Don't close it.'''
+        con = getattr(self._local, 'con', None)
+        # A connection can't be carried across a fork, so children get their own
+        if con is None or self._local.pid != os.getpid():
+            con = sqlite3.connect(self._file, timeout=30)
+            con.execute('pragma journal_mode=wal')
+            con.execute('pragma synchronous=normal')
+            con.execute('pragma foreign_keys=on')
+            con.execute('pragma temp_store=memory')
+            con.execute('pragma cache_size=-8000')
+            self._local.con = con
+            self._local.pid = os.getpid()
+        return con
+
+    def _migrate(self, con):
+        version = con.execute('pragma user_version').fetchone()[0]
+        if version >= self._version:
+            return
+        log.info('Migrating database from version %i to %i', version, self._version)
+        with con:
+            if version < 1:
+                # services never had a unique name, so authenticate could add a
+                # service more than once. Fold duplicates into the first row
+                # and keep the newest value of each token before adding keys.
+                con.execute(
+                    '''
+                    update service_auth
+                    set service_id = (
+                        select min(s2.service_id)
+                        from services s1 join services s2 using (service_name)
+                        where s1.service_id = service_auth.service_id)
+                    where service_id in (select service_id from services) ''')
+                con.execute(
+                    '''
+                    delete from services
+                    where service_id not in (
+                        select min(service_id) from services group by service_name) ''')
+                con.execute(
+                    '''
+                    delete from service_auth
+                    where rowid not in (
+                        select max(rowid) from service_auth group by service_id, token_name) ''')
+                con.execute(
+                    '''
+                    create unique index if not exists services_name
+                    on services (service_name) ''')
+                con.execute(
+                    '''
+                    create unique index if not exists service_auth_token
+                    on service_auth (service_id, token_name) ''')
+                con.execute(
+                    '''
+                    create index if not exists jobs_stage
+                    on jobs (stage, updated) ''')
+            if version < 2:
+                # dedup looks up copies in flight by content
+                con.execute(
+                    '''
+                    create index if not exists jobs_hash
+                    on jobs (content_hash) ''')
+            if version < 3:
+                # Where a job's file was archived from, until the move is done
+                columns = [row[1] for row in con.execute('pragma table_info(jobs)')]
+                if 'source' not in columns:
+                    con.execute('alter table jobs add column source text')
+            con.execute('pragma user_version = %i' % self._version)
+
+    def service_id(self, service):
+        '''Return the id for service, adding it on first use.'''
+        with self._lock:
+            if service in self._service_ids:
+                return self._service_ids[service]
+        con = self.connect()
+        with con:
+            con.execute(
+                """
+                insert or ignore into services (service_name)
+                values (?) """, (service,))
+        service_id = con.execute(
+            """
+            select service_id
+            from services
+            where service_name = ? """, (service,)).fetchone()[0]
+        with self._lock:
+            self._service_ids[service] = service_id
+        return service_id
+
+    def get_token(self, service, name):
+        '''Return the stored value of service's token name, or None.'''
+        with self._lock:
+            if (service, name) in self._tokens:
+                return self._tokens[(service, name)]
+        row = self.connect().execute(
+            """
+            select token_value
+            from service_auth
+            where service_id = ? and token_name = ? """,
+            (self.service_id(service), name)).fetchone()
+        value = row[0] if row else None
+        with self._lock:
+            self._tokens[(service, name)] = value
+        return value
+
+    def set_token(self, service, name, value):
+        '''Store value as service's token name, replacing any previous one.'''
+        service_id = self.service_id(service)
+        with self._lock:
+            if self._tokens.get((service, name)) == value:
+                return
+        con = self.connect()
+        with con:
+            con.execute(
+                """
+                insert or replace into service_auth (service_id, token_name, token_value)
+                values (?, ?, ?) """, (service_id, name, value))
+        with self._lock:
+            self._tokens[(service, name)] = value
+
+
+class Journal(object):
+    '''
+    Durable record of the work in flight so queued resizes and uploads survive
+    a restart. There is a row per archived file and service, moving from the
+    resize stage to the upload stage and removed once uploaded. Uploads that
+    failed outright stay behind in the failed stage. Rows for a file being
+    moved into the archive keep the path it's coming from until it's there.
+
+    Stage changes are queued and applied by a single thread, each batch in
+    one transaction on a WAL mode database, so journaling never holds up the
+    pipeline. Forked resize processes don't have that thread and write
+    straight to the database instead. Adding and forgetting a job are written
+    straight away too, as the file is moved into the archive in between.
+    '''
+    _db = None
+    _queue = None
+    _owner = None
+    _batch = 500
+
+    def __init__(self, db):
+        super(Journal, self).__init__()
+        self._db = db
+        self._queue = Queue.Queue()
+        self._owner = os.getpid()
+        newthread = threading.Thread(target=self._writer, name='journal')
+        newthread.daemon = True
+        newthread.start()
+
+    def _writer(self):
+        con = self._db.connect()
+        while True:
+            ops = [self._queue.get()]
+            # Take whatever else piled up while the last batch committed
+            while len(ops) < self._batch:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                with con:
+                    for sql, args in ops:
+                        con.execute(sql, args)
+            except sqlite3.Error:
+                log.exception('Unable to write %i journal entries', len(ops))
+            finally:
+                for i in ops:
+                    self._queue.task_done()
+
+    def add(self, job, services, source=None):
+        '''Record job as waiting to be resized for services, its file about
+        to be moved there from source if given. The rows are committed by the
+        time this returns.'''
+        self._write([(
+            """
+            insert or replace into jobs
+                (file, service_name, stage, format, content_hash, phash, source)
+            values (?, ?, 'resize', ?, ?, ?, ?) """,
+            (job['file'], s, job['format'], job['hash'],
+             '%016x' % job['phash'] if job['phash'] is not None else None, source))
+            for s in services])
+
+    def moved(self, job):
+        '''Record that job's file has been moved into place, committed by the
+        time this returns.'''
+        self._write([(
+            """
+            update jobs
+            set source = null
+            where file = ? """,
+            (job['file'],))])
+
+    def forget(self, job):
+        '''Remove every row for job, committed by the time this returns.'''
+        self._write([(
+            """
+            delete from jobs
+            where file = ? """,
+            (job['file'],))])
+
+    def uploading(self, job, service, passthrough):
+        '''Record that job has been resized for service and is waiting to
+        upload. passthrough means the archived file is sent as is.'''
+        self._set(job['file'], service, 'upload', passthrough)
+
+    def failed(self, job, service):
+        self._set(job['file'], service, 'failed')
+
+    def done(self, job, service):
+        self._put((
+            """
+            delete from jobs
+            where file = ? and service_name = ? """,
+            (job['file'], service)))
+
+    def _set(self, file, service, stage, passthrough=False):
+        self._put((
+            """
+            update jobs
+            set stage = ?, passthrough = ?, updated = current_timestamp
+            where file = ? and service_name = ? """,
+            (stage, int(passthrough), file, service)))
+
+    def _put(self, op):
+        if os.getpid() == self._owner:
+            self._queue.put(op)
+            return
+        try:
+            self._write([op])
+        except sqlite3.Error:
+            log.exception('Unable to write a journal entry')
+
+    def _write(self, ops):
+        con = self._db.connect()
+        with con:
+            for sql, args in ops:
+                con.execute(sql, args)
+
+    def unfinished(self):
+        '''Return (file, service_name, stage, format, content_hash, phash,
+        passthrough, source) for every job that was still in flight. phash is
+        hex and source is None once the file was moved into place.'''
+        self.flush()
+        return self._db.connect().execute(
+            """
+            select file, service_name, stage, format, content_hash, phash, passthrough, source
+            from jobs
+            where stage in ('resize', 'upload')
+            order by updated """).fetchall()
+
+    def flush(self):
+        '''Block until every queued write has been committed.'''
+        self._queue.join()
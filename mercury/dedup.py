@@ -0,0 +1,222 @@
+'''
+dedup.py
+Index of what has already been uploaded where, so re-exported or re-copied
+images aren't sent to the same service twice.
+
+Files are matched exactly by content hash, against what has been uploaded
+and, through the job journal, against copies still on their way, so copies
+dispatched together only go once. Without the journal that second part is
+lost. Optionally they are also matched by a 64 bit perceptual difference
+hash, kept in memory in a multi-index hamming table so lookups within a small
+distance stay well under a millisecond with hundreds of thousands of entries.
+'''
+import hashlib
+import json
+import threading
+
+from PIL import Image
+
+import mercury.log
+
+log = mercury.log.getLogger()
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def enabled(config):
+    if 'dedup' in config and config['dedup'] is not None:
+        return bool(config['dedup'])
+    return True
+
+
+def perceptual(config):
+    return 'dedup_perceptual' in config and bool(config['dedup_perceptual'])
+
+
+def _distance(config):
+    if 'dedup_distance' in config and config['dedup_distance'] is not None:
+        return int(config['dedup_distance'])
+    return 4
+
+
+def content_hash(path):
+    '''Return the hex sha1 of the file at path.'''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def perceptual_hash(path):
+    '''
+    Return a 64 bit difference hash of the image at path, or None if it can't
+    be read. Each bit says whether a pixel is brighter than its right hand
+    neighbour in a 9x8 greyscale thumbnail, which survives re-encoding and
+    resizing. JPEGs are drafted down so only a fraction is decoded.
+    '''
+    try:
+        img = Image.open(path)
+        img.draft('L', (64, 64))
+        img = img.convert('L').resize((9, 8), Image.ANTIALIAS)
+    except IOError:
+        log.debug('Unable to hash %s', path)
+        return None
+    pixels = list(img.getdata())
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return h
+
+
+def _signed(h):
+    # sqlite integers are signed 64 bit
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+def _unsigned(h):
+    return h + (1 << 64) if h < 0 else h
+
+
+def lookup(config, digest, in_flight=False):
+    '''
+    Return {service_name: result} for uploads of this exact content. With
+    in_flight, services the job journal has a copy on its way to are
+    included too, with a result of None. Both are read at once so an upload
+    finishing in between can't be missed.
+    '''
+    sql = """
+        select service_name, result
+        from uploads
+        where content_hash = ? """
+    args = (digest,)
+    if in_flight:
+        sql += """
+        union all
+        select service_name, null
+        from jobs
+        where content_hash = ? and stage in ('resize', 'upload') """
+        args = (digest, digest)
+    found = {}
+    for service, result in config['db'].connect().execute(sql, args):
+        if found.get(service) is None:
+            found[service] = result
+    return found
+
+
+def lookup_similar(config, digest, phash):
+    '''
+    Return {service_name: result} for uploads that look like the image with
+    perceptual hash phash. Matches are also recorded against digest so the
+    next copy is caught by the exact lookup.
+    '''
+    index = _load(config)
+    with _index_lock:
+        matches = index.find(phash)
+    found = {}
+    for match in matches:
+        for service, result in lookup(config, match).items():
+            if service not in found:
+                log.debug('%s looks like %s on %s', digest, match, service)
+                found[service] = result
+    for service in found:
+        _insert(config, digest, phash, service, found[service])
+    return found
+
+
+def record(config, job, service, result):
+    '''Remember that job's file was uploaded to service.'''
+    if not job['hash']:
+        return
+    _insert(config, job['hash'], job['phash'], service, _describe(result))
+
+
+def _insert(config, digest, phash, service, result):
+    con = config['db'].connect()
+    with con:
+        con.execute(
+            """
+            insert or replace into uploads (content_hash, service_name, phash, result)
+            values (?, ?, ?, ?) """,
+            (digest, service, _signed(phash) if phash is not None else None, result))
+    if phash is not None and _index is not None:
+        with _index_lock:
+            _index.add(phash, digest)
+
+
+def _describe(result):
+    '''Boil a service's upload result down to something worth storing.'''
+    if hasattr(result, 'link'):  # imgur
+        return result.link
+    if hasattr(result, 'text'):  # requests responses from sta.sh
+        return result.text
+    if isinstance(result, dict):  # tumblr
+        return json.dumps(result)
+    return str(result)
+
+
+def _load(config):
+    '''Build the hamming index from the database the first time it's needed.'''
+    global _index
+    with _index_lock:
+        if _index is None:
+            index = HammingIndex(_distance(config))
+            for digest, phash in config['db'].connect().execute(
+                    """
+                    select distinct content_hash, phash
+                    from uploads
+                    where phash is not null """):
+                index.add(_unsigned(phash), digest)
+            log.debug('Loaded %i perceptual hashes.', len(index))
+            _index = index
+    return _index
+
+
+class HammingIndex(object):
+    '''
+    Multi-index hashing over 64 bit hashes. Each hash is split into maxdist + 1
+    chunks with an exact lookup table per chunk. Any hash within maxdist bits
+    of a query has to match it exactly on at least one chunk, so a search only
+    compares against the few hashes sharing a chunk value.
+    '''
+    _maxdist = None
+    _chunks = None
+    _tables = None
+    _values = None
+
+    def __init__(self, maxdist):
+        self._maxdist = min(max(maxdist, 0), 63)
+        count = self._maxdist + 1
+        bounds = [64 * i // count for i in range(count + 1)]
+        self._chunks = [(bounds[i], (1 << (bounds[i + 1] - bounds[i])) - 1) for i in range(count)]
+        self._tables = [{} for i in range(count)]
+        self._values = {}
+
+    def add(self, h, value):
+        if h not in self._values:
+            self._values[h] = set()
+            for (shift, mask), table in zip(self._chunks, self._tables):
+                table.setdefault((h >> shift) & mask, []).append(h)
+        self._values[h].add(value)
+
+    def find(self, h):
+        '''Return the values stored within maxdist of h.'''
+        found = set()
+        seen = set()
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            for candidate in table.get((h >> shift) & mask, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                if hamming(h, candidate) <= self._maxdist:
+                    found.update(self._values[candidate])
+        return found
+
+    def __len__(self):
+        return len(self._values)
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
@@ -2,24 +2,136 @@
 dispatcher.py
 tasked to create queue items for each file found
 '''
+import collections
+import errno
+import heapq
+import io
+import itertools
 import multiprocessing
 import os.path
+import Queue
 import shutil
 import threading
 import tempfile
+import time
 import traceback
 
+import PIL
 from PIL import Image
 
+import mercury.dedup
+import mercury.metrics
+import mercury.priority
+import mercury.reactor
+import mercury.resilience
 import mercury.services
+import mercury.sessions
 import mercury.log
 
+try:
+    import pyvips
+except (ImportError, OSError):
+    # OSError when the binding is installed but libvips itself isn't
+    pyvips = None
+
 log = mercury.log.getLogger()
 
 _upload = multiprocessing.Queue()
 
-# A list of all the dynamically created resize worker objects
+# A list of all the dynamically created resize worker objects, and the
+# processes they share
 resizeworkers = []
+resizepool = None
+
+# Threads feeding files through dispatch()
+dispatchworkers = None
+_claims = threading.Lock()
+
+# Per service upload queues, fed from _upload so each service has its own
+# backlog and a slow host can't hold up the others
+uploadqueues = {}
+uploadengine = None
+
+
+class Budget(object):
+    '''
+    A count of bytes in flight shared between the dispatcher, resize processes
+    and upload threads. Only the entrance to the pipeline blocks on it, later
+    stages just account for what they hold so work already admitted can always
+    drain. A limit of 0 means unlimited.
+    '''
+    def __init__(self):
+        self._cond = multiprocessing.Condition()
+        self._used = multiprocessing.Value('L', 0, lock=False)
+        self._limit = multiprocessing.Value('L', 0, lock=False)
+
+    def acquire(self, n):
+        '''Block until n bytes fit within the limit, then take them. Anything
+        is let through when nothing else is in flight so oversized images
+        can't wedge the pipeline.'''
+        with self._cond:
+            while self._limit.value and self._used.value and \
+                    self._used.value + n > self._limit.value:
+                self._cond.wait()
+            self._used.value += n
+
+    def charge(self, n):
+        '''Take n bytes without waiting.'''
+        with self._cond:
+            self._used.value += n
+
+    def release(self, n):
+        '''Give back n bytes. Giving back more than is held is a bug in the
+        caller's accounting; it's logged and the count stops at 0.'''
+        with self._cond:
+            used = self._used.value
+            self._used.value -= min(n, used)
+            self._cond.notify_all()
+        if n > used:
+            log.error('Released %i bytes from the budget with only %i in use.', n, used)
+            log.debug(''.join(traceback.format_stack()))
+
+    @property
+    def used(self):
+        return self._used.value
+
+    @property
+    def limit(self):
+        return self._limit.value
+
+    @limit.setter
+    def limit(self, value):
+        with self._cond:
+            self._limit.value = value
+            self._cond.notify_all()
+
+
+class Pending(object):
+    '''
+    A count of work items anywhere past dispatch(), queued for or inside a
+    resize or upload worker. Shared across processes so callers can tell when
+    the whole pipeline has drained.
+    '''
+    def __init__(self):
+        self._lock = multiprocessing.Lock()
+        self._count = multiprocessing.Value('l', 0, lock=False)
+
+    def add(self, n=1):
+        with self._lock:
+            self._count.value += n
+
+    def done(self, n=1):
+        with self._lock:
+            self._count.value -= n
+
+    @property
+    def count(self):
+        return self._count.value
+
+
+# Created at import so forked resize workers share them
+budget = Budget()
+pending = Pending()
 
 
 def img_pickle(image):
@@ -37,47 +149,520 @@ def img_unpickle(pickled):
     return Image.frombytes(**pickled)
 
 
-def dispatch(config, file):
+def img_encode(image, format, **options):
+    '''Return the bytes of image encoded as format, options being passed on
+    to Pillow's save().'''
+    buf = io.BytesIO()
+    image.save(buf, format, **options)
+    return buf.getvalue()
+
+
+# How a service wants what it's sent encoded. A format of None keeps the
+# source's, and any other setting left as None keeps Pillow's default.
+class EncodeProfile(collections.namedtuple('EncodeProfile', 'format quality progressive subsampling max_bytes')):
+    __slots__ = ()
+
+    def passes(self, format, size):
+        '''Whether a file in format of size bytes can be sent untouched.'''
+        return self.format in (None, format) and self.quality is None and \
+            not self.progressive and self.subsampling is None and \
+            (not self.max_bytes or size <= self.max_bytes)
+
+
+# Formats a profile may convert to, and the quality Pillow uses for the lossy
+# ones when none is given
+ENCODE_FORMATS = ('JPEG', 'PNG', 'WEBP')
+_default_quality = {'JPEG': 75, 'WEBP': 80}
+
+# The lowest quality max_bytes will go down to
+_min_quality = 20
+
+
+def encode_profile(config, service):
+    '''
+    Return the EncodeProfile for service from its format, quality,
+    progressive, subsampling and max_bytes settings. Each can also be set
+    globally, the service's own setting winning. subsampling is 4:4:4, 4:2:2
+    or 4:2:0 for JPEG, and must be quoted in YAML.
+    '''
+    settings = {}
+    for source in (config, config['services'][service] or {}):
+        for key in EncodeProfile._fields:
+            if key in source and source[key] is not None:
+                settings[key] = source[key]
+
+    format = settings.get('format')
+    if format:
+        format = str(format).upper()
+        if format == 'JPG':
+            format = 'JPEG'
+        Image.init()
+        if format not in ENCODE_FORMATS or format not in Image.SAVE:
+            log.warning('Cannot encode %s for %s, keeping source formats.', format, service)
+            format = None
+        elif service in mercury.services.registry and \
+                hasattr(mercury.services.registry[service], 'formats') and \
+                format not in mercury.services.registry[service].formats:
+            log.warning('%s may not accept %s images.', service, format)
+    else:
+        format = None
+
+    subsampling = settings.get('subsampling')
+    if isinstance(subsampling, int) and subsampling > 2:
+        # YAML 1.1 reads an unquoted 4:2:0 as a base 60 number
+        subsampling = '%i:%i:%i' % (subsampling // 3600, subsampling // 60 % 60, subsampling % 60)
+
+    quality = settings.get('quality')
+    max_bytes = settings.get('max_bytes')
+    return EncodeProfile(format,
+                         int(quality) if quality else None,
+                         bool(settings['progressive']) if 'progressive' in settings else None,
+                         subsampling,
+                         int(max_bytes) if max_bytes else None)
+
+
+def img_encode_profile(image, format, profile):
+    '''
+    Return (data, format) for image encoded as profile says, format being the
+    source's. Past max_bytes, lossy formats are binary searched for the best
+    quality that fits, all in memory, so nothing oversized goes on the wire
+    only to be refused. If even the lowest quality is too big, or the format
+    isn't lossy, the smallest encoding made is returned and left to the
+    service.
+    '''
+    format = profile.format or format
+    image = _encodable(image, format)
+    options = {}
+    if format == 'JPEG':
+        # Lossless, only costs another pass over the entropy coding
+        options['optimize'] = True
+        if profile.progressive:
+            options['progressive'] = True
+        if profile.subsampling is not None:
+            options['subsampling'] = profile.subsampling
+    if profile.quality and format in _default_quality:
+        options['quality'] = profile.quality
+    data = img_encode(image, format, **options)
+    if not profile.max_bytes or len(data) <= profile.max_bytes:
+        return data, format
+
+    if format not in _default_quality:
+        log.warning('%i bytes of %s is over max_bytes of %i, and only lossy formats can be made to fit.',
+            len(data), format, profile.max_bytes)
+        return data, format
+
+    smallest = data
+    low, high = _min_quality, (profile.quality or _default_quality[format]) - 1
+    best = None
+    while low <= high:
+        options['quality'] = (low + high) // 2
+        data = img_encode(image, format, **options)
+        if len(data) <= profile.max_bytes:
+            best = data
+            low = options['quality'] + 1
+        else:
+            smallest = min(smallest, data, key=len)
+            high = options['quality'] - 1
+    if best is None:
+        log.warning('%s still %i bytes at quality %i, over max_bytes of %i.',
+            format, len(smallest), _min_quality, profile.max_bytes)
+        return smallest, format
+    log.debug('Encoded %s at quality %i to fit in %i bytes.', format, high, profile.max_bytes)
+    return best, format
+
+
+def _encodable(image, format):
+    '''Return image in a mode format can hold, transparency flattened onto
+    white for JPEG.'''
+    alpha = image.mode in ('RGBA', 'LA', 'PA') or \
+        (image.mode == 'P' and 'transparency' in image.info)
+    if format == 'JPEG' and image.mode not in ('RGB', 'L', 'CMYK'):
+        if not alpha:
+            return image.convert('RGB')
+        image = image.convert('RGBA')
+        flat = Image.new('RGB', image.size, (255, 255, 255))
+        flat.paste(image, mask=image.split()[3])
+        return flat
+    if format == 'WEBP' and image.mode not in ('RGB', 'RGBA'):
+        return image.convert('RGBA' if alpha else 'RGB')
+    if format == 'PNG' and image.mode == 'CMYK':
+        return image.convert('RGB')
+    return image
+
+
+def fit_size(size, box):
+    '''Return the size thumbnail() would produce when fitting size into box.'''
+    x, y = size
+    if x > box[0]:
+        y = int(max(y * box[0] / x, 1))
+        x = int(box[0])
+    if y > box[1]:
+        x = int(max(x * box[1] / y, 1))
+        y = int(box[1])
+    return (x, y)
+
+
+def normalize_size(size):
+    '''
+    if either part of size is -1, treat it as 9,999,999 instead
+    if both are, return None to skip resizing and write file as is
+    '''
+    if bool(size[0] == -1) != bool(size[1] == -1):
+        if size[0] == -1:
+            return (9999999, size[1])
+        else:
+            return (size[0], 9999999)
+    elif size[0] == -1 and size[1] == -1:
+        return None
+    return size
+
+
+# Resampling filters a service can ask for, fastest first
+RESAMPLE = collections.OrderedDict([
+    ('nearest', Image.NEAREST),
+    ('bilinear', Image.BILINEAR),
+    ('bicubic', Image.BICUBIC),
+    ('lanczos', Image.LANCZOS),
+])
+
+
+class PillowBackend(object):
+    '''
+    Resizes with Pillow, or with pillow-simd when that's installed in its
+    place. Images not yet decoded are drafted first, so JPEGs are scaled down
+    by the decoder to no less than reducing_gap times the target. With a
+    reducing_gap, whatever is left over that is also shrunk by a whole factor
+    with a box filter before the real resample, which is much cheaper for big
+    reductions and hard to tell apart from a full resample once the gap is 2
+    or more. Pillow 7 and later do this themselves.
+    '''
+    _native_gap = hasattr(Image.Image, 'reduce')
+
+    @property
+    def name(self):
+        # pillow-simd versions itself as Pillow's with a .postN suffix
+        version = getattr(PIL, '__version__', getattr(PIL, 'PILLOW_VERSION', ''))
+        return 'pillow-simd' if '.post' in version else 'pillow'
+
+    def resize(self, image, size, resample, reducing_gap=None):
+        '''Return image resized to exactly size using the named resample
+        filter. image may be opened but not yet loaded.'''
+        gap = reducing_gap or 1.0
+        image.draft(image.mode, (int(size[0] * gap), int(size[1] * gap)))
+        if image.size == size:
+            return image
+        if reducing_gap and self._native_gap:
+            return image.resize(size, RESAMPLE[resample], reducing_gap=reducing_gap)
+        if reducing_gap:
+            factor = int(min(image.size[0] / float(size[0]), image.size[1] / float(size[1])) / reducing_gap)
+            if factor > 1:
+                image = image.resize((-(-image.size[0] // factor), -(-image.size[1] // factor)), Image.BOX)
+        return image.resize(size, RESAMPLE[resample])
+
+
+class VipsBackend(object):
+    '''
+    Resizes with libvips through pyvips. An image Pillow hasn't decoded yet is
+    read straight from its file by libvips, streaming, so only the output is
+    ever held in full. Loaded images are copied over and back. Modes other
+    than 8 bit L, RGB and RGBA are left to Pillow, and reducing_gap needs
+    libvips 8.13 or later.
+    '''
+    name = 'vips'
+    _kernels = {'nearest': 'nearest', 'bilinear': 'linear', 'bicubic': 'cubic', 'lanczos': 'lanczos3'}
+    _bands = {'L': 1, 'RGB': 3, 'RGBA': 4}
+    _fallback = None
+
+    def __init__(self):
+        super(VipsBackend, self).__init__()
+        self._fallback = PillowBackend()
+
+    def resize(self, image, size, resample, reducing_gap=None):
+        '''Return image resized to exactly size using the named resample
+        filter. image may be opened but not yet loaded.'''
+        if image.mode not in self._bands:
+            return self._fallback.resize(image, size, resample, reducing_gap)
+        source = None
+        if image.im is None and getattr(image, 'filename', None):
+            source = pyvips.Image.new_from_file(image.filename, access='sequential')
+            if source.bands != self._bands[image.mode] or source.format != 'uchar':
+                source = None
+        if source is None:
+            image.load()
+            source = pyvips.Image.new_from_memory(image.tobytes(), image.size[0], image.size[1],
+                                                  self._bands[image.mode], 'uchar')
+        if (source.width, source.height) == size:
+            resized = source
+        else:
+            options = {'vscale': size[1] / float(source.height), 'kernel': self._kernels[resample]}
+            if reducing_gap:
+                options['gap'] = reducing_gap
+            resized = source.resize(size[0] / float(source.width), **options)
+        return Image.frombytes(image.mode, (resized.width, resized.height), resized.write_to_memory())
+
+
+# Resize backends by the name resize_backend picks them with
+backends = {'pillow': PillowBackend}
+if pyvips:
+    backends['vips'] = VipsBackend
+
+
+def resize_backend(config):
+    '''Return the backend named by resize_backend, Pillow by default or
+    when the one named isn't installed.'''
+    name = 'pillow'
+    if 'resize_backend' in config and config['resize_backend']:
+        name = config['resize_backend']
+    if name not in backends:
+        log.warning('Resize backend %s is not available, using pillow.', name)
+        name = 'pillow'
+    return backends[name]()
+
+
+def resize_settings(config, service):
+    '''
+    Return (resample, reducing_gap) for service. Both can be set per service
+    or globally, the service's own setting winning. resample is one of
+    RESAMPLE and defaults to lanczos, reducing_gap defaults to None, meaning
+    every reduction is a full resample.
+    '''
+    resample = 'lanczos'
+    reducing_gap = None
+    for settings in (config, config['services'][service] or {}):
+        if 'resample' in settings and settings['resample']:
+            resample = str(settings['resample']).lower()
+        if 'reducing_gap' in settings and settings['reducing_gap']:
+            reducing_gap = float(settings['reducing_gap'])
+    if resample not in RESAMPLE:
+        log.warning('Unknown resample %s for %s, using lanczos.', resample, service)
+        resample = 'lanczos'
+    return (resample, reducing_gap)
+
+
+def _claim_archive_path(dest, name):
+    '''
+    Return a free path for name in dest, adding a counter before the extension
+    on collisions. The path is claimed by creating it empty so concurrent
+    dispatches can't pick the same one.
+    '''
+    parts = name.split('.')
+    counter = 0
+    while True:
+        candidate = parts[:]
+        if counter:
+            candidate.insert(-1, counter)
+        candidate = dest.rstrip('/') + '/' + '.'.join([str(i) for i in candidate])
+        try:
+            os.close(os.open(candidate, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return candidate
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        counter += 1
+
+
+def dispatch(config, file, archive=True):
+    '''
+    Send the image at file to every service that doesn't have it yet. It's
+    moved into the archive folder first unless archive is False, when it's
+    uploaded from where it is.
+    '''
     global resizeworkers
 
     # Assume for now we have at least one service to send to
-    log.debug('Dispatcher called for file: %s' % file)
-    log.debug('I got a config file with %i elements.' % len(config))
+    log.debug('Dispatcher called for file: %s', file)
+    log.debug('I got a config file with %i elements.', len(config))
 
+    opened = time.time()
     # Opening the image w/ Pillow should be all the filtering we need
     try:
         img = Image.open(file)
     except IOError:
-        log.debug('Image file not appropriate for processing: %s' % file)
+        log.debug('Image file not appropriate for processing: %s', file)
         log.debug(traceback.format_exc())
+        mercury.metrics.count('mercury_files_total', result='ignored')
         return
+    # Only the header has been read. Resize workers decode from the archived
+    # file themselves, so don't hold onto pixels here.
+    format = str(img.format)
+    cost = img.size[0] * img.size[1] * len(img.getbands())
+    img.close()
+    priority = mercury.priority.folder_priority(config, file)
+
+    # Leave out services that already have this image
+    services = [s for s in config['services'] if s in mercury.services.registry]
+    digest, phash = None, None
+    done = {}
+    if mercury.dedup.enabled(config):
+        digest = mercury.dedup.content_hash(file)
+        done = mercury.dedup.lookup(config, digest)
+        if mercury.dedup.perceptual(config) and [s for s in services if s not in done]:
+            phash = mercury.dedup.perceptual_hash(file)
+            if phash is not None:
+                done.update(mercury.dedup.lookup_similar(config, digest, phash))
+    journal = None
+    if 'journal' in config and config['journal']:
+        journal = config['journal']
+
+    # Looking again for copies in flight and journaling the job go together,
+    # so of two copies dispatched at once only the first is sent
+    with _claims:
+        if digest:
+            done.update(mercury.dedup.lookup(config, digest, in_flight=True))
+        for s in done:
+            if done[s] is None:
+                log.info('%s is already on its way to %s, skipping.', file, s)
+            else:
+                log.info('%s was already uploaded to %s, skipping: %s', file, s, done[s])
+            mercury.metrics.count('mercury_uploads_total', service=s, result='duplicate')
+        services = [s for s in services if s not in done]
+
+        newfile = file
+        if archive:
+            newfile = _archive_path(config, file)
+        job = {
+            'file': newfile,
+            'format': format,
+            'cost': cost,
+            'services': services,
+            'hash': digest,
+            'phash': phash,
+            'priority': priority
+        }
+        # Journal the job under its archived path before moving, so a crash
+        # part way through leaves a row replay can make sense of
+        try:
+            if journal:
+                journal.add(job, services, file if archive else None)
+        except:
+            if archive:
+                os.remove(newfile)
+            raise
+    mercury.metrics.observe('mercury_stage_seconds', time.time() - opened, stage='open')
+    workers = [i for i in resizeworkers if [s for s in i.services if s in services]]
+
+    reserved = 0
+    try:
+        # Wait for room for every worker's decode before taking on the file
+        if workers:
+            log.debug('Reserving %i bytes for decoding, %i of %i in use.',
+                cost * len(workers), budget.used, budget.limit)
+            budget.acquire(cost * len(workers))
+            reserved = cost * len(workers)
+
+        moved = time.time()
+        if archive:
+            shutil.move(file, newfile)
+            if journal:
+                journal.moved(job)
+    except:
+        # Until the job is submitted the reservation is ours to give back
+        if journal:
+            journal.forget(job)
+        if archive:
+            os.remove(newfile)
+        budget.release(reserved)
+        raise
+    if archive:
+        mercury.metrics.observe('mercury_stage_seconds', time.time() - moved, stage='move')
+    mercury.metrics.count('mercury_files_total', result='dispatched')
+    mercury.metrics.count('mercury_bytes_in_total', os.path.getsize(newfile))
+    _submit(job, workers)
 
+
+def _archive_path(config, file):
+    '''Claim and return the path file will be archived to.'''
     if 'archive_folder' in config and config['archive_folder']:
         dest = os.path.abspath(config['archive_folder'])
     else:
         dest = os.path.dirname(os.path.abspath(config['watched_folder']))
 
     # Check for collisions and rename appropriately
-    newfile = dest.rstrip('/') + '/' + os.path.basename(file)
-    if os.path.exists(newfile):
+    newfile = _claim_archive_path(dest, os.path.basename(file))
+    if os.path.basename(newfile) != os.path.basename(file):
         log.debug('File already exists in archive location.')
-        parts = os.path.basename(newfile).split('.')
-        parts.insert(-1, 1)
-        while os.path.exists(dest.rstrip('/') + '/' + '.'.join([str(i) for i in parts])):
-            parts[-2] += 1
-        newfile = dest.rstrip('/') + '/' + '.'.join([str(i) for i in parts])
-        log.debug('New file location: %s' % newfile)
+        log.debug('New file location: %s', newfile)
+    return newfile
+
+
+def _submit(job, workers):
+    pending.add(len(workers))
+    for i in workers:
+        i.put(job)
+
 
-    shutil.move(file, newfile)
-    file = newfile
+def replay(config):
+    '''
+    Requeue the work that was still in flight when mercury last stopped.
+    Files already archived pick up from the last stage they finished:
+    originals waiting to be passed through go straight to upload, everything
+    else is resized again from the archived file. Files that were still being
+    moved into the archive are dispatched again from where they came from.
+    '''
+    if 'journal' not in config or not config['journal']:
+        return
+    journal = config['journal']
+
+    jobs = {}
+    for file, service, stage, format, digest, phash, passthrough, source in journal.unfinished():
+        if file not in jobs:
+            jobs[file] = ({
+                'file': file,
+                'format': format,
+                'cost': 0,
+                'services': [],
+                'hash': digest,
+                'phash': int(phash, 16) if phash else None,
+                'priority': 0
+            }, [], source)
+        job, direct, source = jobs[file]
+        if service not in uploadqueues:
+            log.warning('Service %s is no longer loaded, not replaying %s for it.', service, file)
+            continue
+        if stage == 'upload' and passthrough:
+            direct.append(service)
+        else:
+            job['services'].append(service)
+    if jobs:
+        log.info('Replaying %i unfinished job(s) from the journal.', len(jobs))
+
+    for file in jobs:
+        job, direct, source = jobs[file]
+        if source and os.path.exists(source):
+            # Stopped before the move finished. What's in the archive is an
+            # empty placeholder or a partial copy, the original is intact.
+            log.info('%s was never archived, dispatching it again.', source)
+            journal.forget(job)
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+            dispatchworkers.put(source)
+            continue
+        try:
+            img = Image.open(file)
+            job['cost'] = img.size[0] * img.size[1] * len(img.getbands())
+            img.close()
+        except IOError:
+            log.warning('Archived file %s is gone or unreadable, giving up on it.', file)
+            for s in direct + job['services']:
+                journal.failed(job, s)
+            continue
+
+        for s in direct:
+            pending.add()
+            _upload.put((None, job['format'], s, job))
 
-    for i in resizeworkers:
-        i.put(img_pickle(img.copy()), str(img.format))
+        workers = [i for i in resizeworkers if [s for s in i.services if s in job['services']]]
+        if workers:
+            budget.acquire(job['cost'] * len(workers))
+            _submit(job, workers)
 
 
 def setup_resize_workers(config):
     global resizeworkers
-    resolutions = {}
+    global resizepool
+    profiles = {}
 
     log.debug('Starting setup_resize_workers')
 
@@ -91,7 +676,7 @@ def setup_resize_workers(config):
         if config['max_yres']:
             yres = config['max_yres']
     default_res = (xres, yres)
-    log.debug('Default resolution of %s set.' % str(default_res))
+    log.debug('Default resolution of %s set.', default_res)
 
     for service in config['services']:
         # Grab resolutions from config and override with global as appropriate
@@ -105,91 +690,405 @@ def setup_resize_workers(config):
             yres = default_res[1]
         res = (xres, yres)
 
-        # Build a unique set of resolutions for workers
-        if res not in resolutions:
-            resolutions[res] = []
-        resolutions[res].append(service)
+        # Build a unique set of resolutions and resampling settings for workers
+        profile = (res,) + resize_settings(config, service)
+        if profile not in profiles:
+            profiles[profile] = []
+        profiles[profile].append(service)
+
+    log.debug('Services found for resize workers: %s', profiles)
+
+    if 'max_inflight_bytes' in config and config['max_inflight_bytes']:
+        budget.limit = int(config['max_inflight_bytes'])
+        log.debug('Limiting bytes in flight to %i', budget.limit)
 
-    log.debug('Services found for resize workers: ')
-    log.debug(resolutions)
+    mercury.metrics.gauge('mercury_budget_bytes', lambda: budget.used)
+    mercury.metrics.gauge('mercury_inflight_items', lambda: pending.count)
 
-    for r in resolutions:
-        log.debug('Creating rescaling process for %s' % str(r))
-        resizeworkers.append(ResizeWorker(config, r, resolutions[r]))
+    processes = multiprocessing.cpu_count()
+    if 'resize_processes' in config and config['resize_processes']:
+        processes = int(config['resize_processes'])
+    resizepool = ResizePool(config, processes)
+    mercury.metrics.gauge('mercury_queue_depth', resizepool.qsize, queue='resize')
+
+    if 'cascade_resize' in config and config['cascade_resize']:
+        log.debug('Creating cascading rescaling for %s', profiles.keys())
+        resizeworkers.append(CascadeResizeWorker(config, resizepool, profiles))
+    else:
+        for profile in profiles:
+            log.debug('Creating rescaling for %s', profile)
+            res, resample, reducing_gap = profile
+            resizeworkers.append(ResizeWorker(config, resizepool, res, profiles[profile],
+                                              resample, reducing_gap))
+    resizepool.start()
+
+
+def setup_dispatch_workers(config):
+    global dispatchworkers
+    count = multiprocessing.cpu_count()
+    if 'dispatch_workers' in config and config['dispatch_workers']:
+        count = int(config['dispatch_workers'])
+    log.debug('Starting %i dispatch worker(s).', count)
+    dispatchworkers = DispatchWorkers(config, count)
+    mercury.metrics.gauge('mercury_queue_depth', dispatchworkers.queue.qsize, queue='dispatch')
+
+
+def _queue_size(config):
+    '''Bound on resize queues, per resolution, so a full pipeline pushes back
+    on dispatch(). 0 is unbounded.'''
+    if 'resize_queue_size' in config and config['resize_queue_size'] is not None:
+        return int(config['resize_queue_size'])
+    return 16
 
 
 def setup_upload_workers(config):
+    global uploadqueues
+    global uploadengine
     log.debug('Setting up upload workers.')
-    # TODO How will this handle services that are configured but not supported?
-    for i in config['services']:
-        UploadWorker(config)
+    engine = None
+    if 'upload_engine' in config and config['upload_engine'] == 'shared':
+        threads = 8
+        if 'upload_threads' in config and config['upload_threads']:
+            threads = int(config['upload_threads'])
+        engine = uploadengine = UploadEngine(config, threads)
+    for service in config['services']:
+        if service not in mercury.services.registry:
+            log.warning('Configured service %s is not loaded. Cannot upload.', service)
+            continue
+
+        concurrency = 1
+        if 'concurrency' in config['services'][service]:
+            if config['services'][service]['concurrency']:
+                concurrency = int(config['services'][service]['concurrency'])
+
+        if engine:
+            uploadqueues[service] = engine.add(service, concurrency)
+        else:
+            uploadqueues[service] = mercury.priority.PriorityQueue(
+                _upload_key(config, service))
+            log.debug('Starting %i upload worker(s) for %s', concurrency, service)
+            for i in range(concurrency):
+                UploadWorker(config, service, uploadqueues[service])
+        mercury.metrics.gauge('mercury_queue_depth', uploadqueues[service].qsize, queue='upload-%s' % service)
+    mercury.metrics.gauge('mercury_queue_depth', _upload.qsize, queue='upload')
+
+    router = threading.Thread(target=_route_uploads, args=(config,), name='upload-router')
+    router.daemon = True
+    router.start()
+
+
+def _upload_key(config, service):
+    return lambda item: mercury.priority.upload_key(config, service, item)
+
+
+def _route_uploads(config):
+    '''Move items from the shared upload queue onto their service's queue.'''
+    while True:
+        item = _upload.get()
+        servicename = item[2]
+        if 'journal' in config and config['journal']:
+            config['journal'].uploading(item[3], servicename, item[0] is None)
+        if servicename not in uploadqueues:
+            log.warning('No upload workers for service %s. Dropping upload.', servicename)
+            if item[0]:
+                budget.release(len(item[0]))
+            pending.done()
+            continue
+        uploadqueues[servicename].put(Upload(*item, attempt=0, budgeted=item[0] is not None, spill=None))
+
+
+class DispatchWorkers(object):
+    '''
+    A pool of threads running dispatch() on queued paths. A path that is
+    already waiting in the queue isn't queued again, so a burst of events for
+    one file collapses into a single dispatch. Paths put with archive False
+    are uploaded in place rather than moved into the archive.
+    '''
+    _config = None
+    _queue = None
+    _waiting = None
+    _lock = None
+
+    def __init__(self, config, count):
+        super(DispatchWorkers, self).__init__()
+        self._config = config
+        self._queue = mercury.priority.PriorityQueue(
+            lambda item: mercury.priority.dispatch_key(config, item[0]))
+        self._waiting = set()
+        self._lock = threading.Lock()
+        for i in range(count):
+            newthread = threading.Thread(target=self._worker)
+            newthread.daemon = True
+            newthread.start()
+            log.debug('Dispatch worker %s started.', newthread.name)
+
+    def _worker(self):
+        while True:
+            path, archive = self._queue.get()
+            # Once started, a new event for the same path is a new file
+            with self._lock:
+                self._waiting.discard(path)
+            try:
+                log.debug('Time to work with the file at %s', path)
+                dispatch(self._config, path, archive)
+            except (IOError, OSError):
+                # The file may have been moved or removed while it waited
+                log.warning('Unable to dispatch %s', path)
+                log.debug(traceback.format_exc())
+            except Exception:
+                # A bad file mustn't take the thread with it. dispatch()
+                # gives back any budget it took before raising.
+                log.exception('Unable to dispatch %s', path)
+                mercury.metrics.count('mercury_files_total', result='failed')
+            finally:
+                self._queue.task_done()
+
+    def put(self, path, archive=True):
+        with self._lock:
+            if path in self._waiting:
+                log.debug('%s is already waiting for dispatch.', path)
+                return
+            self._waiting.add(path)
+        self._queue.put((path, archive))
+
+    def join(self):
+        '''Block until every queued path has been dispatched.'''
+        self._queue.join()
+
+    @property
+    def queue(self):
+        return self._queue
+
+
+class ResizePool(object):
+    '''
+    A fixed set of processes, resize_processes of them or one per CPU, doing
+    the work of every resize worker. Workers are added before start() forks
+    the processes, so each process has its own copy of all of them, and
+    their jobs are queued here as (worker, job) tasks.
+
+    Tasks wait in the main process. A process asks for one whenever it's
+    idle and a scheduler thread hands it the next, so any process works on
+    any tier and none sits idle while another tier has a backlog. Nothing is
+    queued ahead in a busy process for it to be stuck behind, which is what
+    work stealing would otherwise be needed to undo. The next task is the one
+    mercury.priority puts first, a worker's tasks taking the highest
+    priority among its services.
+    '''
+    _config = None
+    _processes = 0
+    _workers = None
+    _priorities = None
+    _tasks = None
+    _order = None
+    _cond = None
+    _limit = 0
+    _ready = None
+    _inboxes = None
+
+    def __init__(self, config, processes):
+        super(ResizePool, self).__init__()
+        self._config = config
+        self._processes = max(1, processes)
+        self._workers = []
+        self._priorities = []
+        self._tasks = []
+        self._order = itertools.count()
+        self._cond = threading.Condition()
+        self._ready = multiprocessing.Queue()
+        self._inboxes = [multiprocessing.Queue() for i in range(self._processes)]
+
+    def add(self, worker):
+        '''Add a worker, returning the number its tasks are queued under.'''
+        self._workers.append(worker)
+        self._priorities.append(max(mercury.priority.service_priority(self._config, s)
+                                    for s in worker.services))
+        self._limit = _queue_size(self._config) * len(self._workers)
+        return len(self._workers) - 1
+
+    def start(self):
+        for i in range(self._processes):
+            newprocess = multiprocessing.Process(target=self._worker, args=(i,))
+            newprocess.daemon = True
+            newprocess.start()
+        log.debug('Started %i resize process(es) for %i worker(s).',
+            self._processes, len(self._workers))
+        newthread = threading.Thread(target=self._schedule, name='resize-scheduler')
+        newthread.daemon = True
+        newthread.start()
+
+    def put(self, index, job):
+        '''Queue job for worker index, blocking while the queue is full.'''
+        key = mercury.priority.resize_key(self._config, job, self._priorities[index])
+        with self._cond:
+            while self._limit and len(self._tasks) >= self._limit:
+                self._cond.wait()
+            heapq.heappush(self._tasks, (key, next(self._order), index, job))
+            self._cond.notify_all()
+
+    def qsize(self):
+        return len(self._tasks)
+
+    def _schedule(self):
+        while True:
+            process = self._ready.get()
+            with self._cond:
+                while not self._tasks:
+                    self._cond.wait()
+                key, order, index, job = heapq.heappop(self._tasks)
+                self._cond.notify_all()
+            self._inboxes[process].put((index, job))
+
+    def _worker(self, process):
+        inbox = self._inboxes[process]
+        try:
+            while True:
+                self._ready.put(process)
+                index, job = inbox.get()
+                try:
+                    self._workers[index].handle(job)
+                except Exception:
+                    # handle() cleans up after its own failures, this only
+                    # keeps the process serving if cleaning up failed too
+                    log.exception('[%s] Resize task for %s failed',
+                        multiprocessing.current_process().name, job['file'])
+        except KeyboardInterrupt:
+            #TODO may want to revisit this and allow process to finish gracefully
+            return
 
 
 class ResizeWorker(object):
     _services = None
     _size = None
-    _queue = None
+    _pool = None
+    _index = None
     _image = None
     _config = None
     _format = None
+    _backend = None
+    _resample = 'lanczos'
+    _reducing_gap = None
+    _profiles = None
+    _handed = None
 
-    def __init__(self, config, size, services):
+    def __init__(self, config, pool, size, services, resample='lanczos', reducing_gap=None):
         super(ResizeWorker, self).__init__()
-        '''
-        if either part of self._size is -1, treat it as 9,999,999 instead
-        if both are, skip resizing and write file as is
-        '''
-        if bool(size[0] == -1) != bool(size[1] == -1):
-            if size[0] == -1:
-                self._size = (9999999, size[1])
-            else:
-                self._size = (size[0], 9999999)
-        elif size[0] == -1 and size[1] == -1:
-            self._size = None
-        else:
-            self._size = size
-
+        self._size = normalize_size(size)
         self._services = services
-        self._queue = multiprocessing.Queue()
+        self._resample = resample
+        self._reducing_gap = reducing_gap
+        self._backend = resize_backend(config)
+        self._profiles = dict((s, encode_profile(config, s)) for s in services)
         self._config = config
+        self._pool = pool
+        self._index = pool.add(self)
+        log.debug('Resize worker for size %s (%s, %s) for service(s) %s',
+            self._size, self._backend.name, self._resample, self._services)
+
+    def handle(self, job):
+        '''Resize job for the services it still needs to go to, then give
+        back what it was holding. Runs in one of the pool's processes, so
+        nothing it raises may get out and end the process.'''
+        self._format = job['format']
+        self._handed = []
+        # Only the services this file still needs to go to
+        services = [s for s in self._services if s in job['services']]
+        try:
+            if services:
+                self._resize(job, services)
+        except Exception:
+            log.exception('[%s: %s] Unable to resize %s, giving up on it.',
+                multiprocessing.current_process().name, services, job['file'])
+            self._failed(job, services)
+        finally:
+            # Whatever happened, the decoded image is gone now
+            self._image = None
+            budget.release(job['cost'])
+            pending.done()
 
-        newprocess = multiprocessing.Process(target=self._worker)
-        newprocess.daemon = True
-        newprocess.start()
-        log.debug('Resize worker %s for started at size %s for service(s) %s' % (
-            newprocess.name, self._size, str(self._services)))
+    def _failed(self, job, services):
+        '''Journal services that weren't handed on to upload as failed, so
+        the file isn't resized again on every restart.'''
+        if 'journal' not in self._config or not self._config['journal']:
+            return
+        for s in services:
+            if s not in self._handed:
+                self._config['journal'].failed(job, s)
+                mercury.metrics.count('mercury_uploads_total', service=s, result='failure')
 
-    def _worker(self):
+    def _resize(self, job, services):
         try:
-            while True:
-                self._image, self._format = self._queue.get()
-                self._image = img_unpickle(self._image)
-                log.debug('[%s: %s] got something to resize, working with %s' % (
-                    multiprocessing.current_process().name, self._services, self._image))
-
-                # Only resize if there is a set size. Else work with full image
-                if self._size:
-                    log.debug('[%s: %s] Resizing to %s' % (
-                        multiprocessing.current_process().name, self._services, self._size))
-                    self._image.thumbnail(self._size, Image.ANTIALIAS)
-                    log.debug('[%s: %s] done with resizing %s.' % (
-                        multiprocessing.current_process().name, self._services, self._image))
-
-                log.debug('Pushing to upload queue.')
-                if len(self._services) == 1:
-                    log.debug('[%s] Pushing image at %s for %s onto upload queue.' % (
-                        multiprocessing.current_process().name, self._image, self._services[0]))
-                    _upload.put((img_pickle(self._image), self._format, self._services[0]))
-                else:  # If there's more than one, push copies
-                    for s in self._services:
-                        log.debug('[%s] Pushing copy of image at %s for %s onto upload queue.' % (
-                            multiprocessing.current_process().name, self._image, s))
-                        _upload.put((img_pickle(self._image.copy()), self._format, s))
-                self._image = None
-        except KeyboardInterrupt:
-            #TODO may want to revisit this and allow process to finish gracefully
+            self._image = Image.open(job['file'])
+        except IOError:
+            log.warning('[%s: %s] Unable to open %s, skipping.',
+                multiprocessing.current_process().name, services, job['file'])
+            self._failed(job, services)
+            return
+        log.debug('[%s: %s] got something to resize, working with %s',
+            multiprocessing.current_process().name, services, self._image)
+
+        # Skip decoding entirely if every service can take the original
+        services = self._passthrough(job, self._image, self._size, services)
+        if not services:
             return
 
+        # Only resize if there is a set size. Else work with full image
+        if self._size:
+            target = fit_size(self._image.size, self._size)
+            log.debug('[%s: %s] Resizing to %s',
+                multiprocessing.current_process().name, services, target)
+            with mercury.metrics.timer('mercury_stage_seconds', stage='resize'):
+                self._image = self._backend.resize(self._image, target,
+                                                   self._resample, self._reducing_gap)
+            log.debug('[%s: %s] done with resizing %s.',
+                multiprocessing.current_process().name, services, self._image)
+
+        self._push(job, services)
+
+    def _passthrough(self, job, image, size, services):
+        '''
+        When image needs no resizing for size, hand the job's archived file
+        straight to each service that accepts its format and whose encode
+        profile leaves it alone, skipping decode and re-encode. Returns the
+        services that still need an encoded copy.
+        '''
+        if size and fit_size(image.size, size) != image.size:
+            return services
+        filesize = os.path.getsize(job['file'])
+        remaining = []
+        for s in services:
+            if s in mercury.services.registry and \
+                    hasattr(mercury.services.registry[s], 'formats') and \
+                    self._format in mercury.services.registry[s].formats and \
+                    self._profiles[s].passes(self._format, filesize):
+                log.debug('[%s] Passing %s through untouched for %s.',
+                    multiprocessing.current_process().name, job['file'], s)
+                pending.add()
+                _upload.put((None, self._format, s, job))
+                self._handed.append(s)
+            else:
+                remaining.append(s)
+        return remaining
+
+    def _push(self, job, services):
+        # Encode once for every service sharing this resolution and encode
+        # profile. Each service gets its own copy off the queue, held until
+        # its upload is done.
+        groups = collections.OrderedDict()
+        for s in services:
+            groups.setdefault(self._profiles[s], []).append(s)
+        for profile, group in groups.items():
+            with mercury.metrics.timer('mercury_stage_seconds', stage='encode'):
+                data, format = img_encode_profile(self._image, self._format, profile)
+            budget.charge(len(data) * len(group))
+            pending.add(len(group))
+            log.debug('Pushing to upload queue.')
+            for s in group:
+                log.debug('[%s] Pushing %i bytes of %s for %s onto upload queue.',
+                    multiprocessing.current_process().name, len(data), format, s)
+                _upload.put((data, format, s, job))
+                self._handed.append(s)
+
     @property
     def services(self):
         return self._services
@@ -198,63 +1097,571 @@ class ResizeWorker(object):
     def size(self):
         return self._size
 
+    def put(self, job):
+        '''
+        Queue a job for resizing. A job is a dict describing one archived file:
+            file: path to the archived file
+            format: its Pillow format name
+            cost: bytes reserved from the budget for decoding it, given back
+                once the worker is done with it
+            services: names of the services it still needs to go to
+            hash: content hash for the dedup index, or None
+            phash: perceptual hash for the dedup index, or None
+            priority: seconds it's moved up the queues, see mercury.priority
+        '''
+        self._pool.put(self._index, job)
+
+
+class CascadeResizeWorker(ResizeWorker):
+    '''
+    Resizes every tier in a single process from one decode. Tiers are worked
+    largest first and each is derived from the smallest tier already produced
+    that is still at least cascade_min_ratio times its size, falling back to
+    the original when none is. Resampling from an image barely larger than the
+    target visibly softens it, hence the guard. For the same reason a tier is
+    only derived from one made with a resample filter at least as good as its
+    own.
+
+    profiles maps (resolution, resample, reducing_gap) to the services
+    wanting that, as built by setup_resize_workers.
+    '''
+    _tiers = None
+    _min_ratio = 2.0
+
+    def __init__(self, config, pool, profiles):
+        self._tiers = [(normalize_size(p[0]), profiles[p], p[1], p[2]) for p in profiles]
+        self._services = [s for p in profiles for s in profiles[p]]
+        if 'cascade_min_ratio' in config and config['cascade_min_ratio']:
+            self._min_ratio = float(config['cascade_min_ratio'])
+        self._backend = resize_backend(config)
+        self._profiles = dict((s, encode_profile(config, s)) for s in self._services)
+        self._config = config
+        self._pool = pool
+        self._index = pool.add(self)
+
+    def _resize(self, job, services):
+        try:
+            original = Image.open(job['file'])
+        except IOError:
+            log.warning('[%s: %s] Unable to open %s, skipping.',
+                multiprocessing.current_process().name, services, job['file'])
+            self._failed(job, services)
+            return
+        log.debug('[%s: %s] got something to resize, working with %s',
+            multiprocessing.current_process().name, services, original)
+
+        # Work out each tier's final size up front, largest first,
+        # leaving out services that can take the original as is.
+        tiers = []
+        for size, tier_services, resample, reducing_gap in self._tiers:
+            tier_services = [s for s in tier_services if s in services]
+            if tier_services:
+                tier_services = self._passthrough(job, original, size, tier_services)
+            if not tier_services:
+                continue
+            target = fit_size(original.size, size) if size else original.size
+            tiers.append((target, tier_services, resample, reducing_gap))
+        if not tiers:
+            return
+        tiers.sort(key=lambda t: t[0][0] * t[0][1], reverse=True)
+
+        # One decode, drafted down only as far as every tier allows
+        draft = (max(int(t[0][0] * (t[3] or 1.0)) for t in tiers),
+                 max(int(t[0][1] * (t[3] or 1.0)) for t in tiers))
+        with mercury.metrics.timer('mercury_stage_seconds', stage='decode'):
+            original.draft(original.mode, draft)
+            original.load()
+
+        rank = RESAMPLE.keys().index
+        produced = []
+        for target, tier_services, resample, reducing_gap in tiers:
+            source = original
+            for candidate, made_with in reversed(produced):
+                if candidate.size[0] >= target[0] * self._min_ratio and \
+                        candidate.size[1] >= target[1] * self._min_ratio and \
+                        rank(made_with) >= rank(resample):
+                    source = candidate
+                    break
+            if source.size == target:
+                self._image = source
+            else:
+                log.debug('[%s: %s] Resizing %s to %s with %s',
+                    multiprocessing.current_process().name, tier_services, source.size, target, resample)
+                with mercury.metrics.timer('mercury_stage_seconds', stage='resize'):
+                    self._image = self._backend.resize(source, target, resample, reducing_gap)
+                produced.append((self._image, resample))
+            self._push(job, tier_services)
+
     @property
-    def queue(self):
-        return self._queue
+    def size(self):
+        return [t[0] for t in self._tiers]
 
-    def put(self, file, format):
-        self._queue.put((file, format))
+
+# What sits on a service's upload queue. attempt counts earlier tries and
+# budgeted says data is still charged against the budget. spill is the
+# temporary file holding data while it waits for a retry or the breaker,
+# data being None meanwhile.
+Upload = collections.namedtuple('Upload', 'data format service job attempt budgeted spill')
 
 
 class UploadWorker(object):
+    '''
+    Uploads items from one service's queue. Failures the service may recover
+    from are put back on the queue after a backoff, without tying up the
+    thread, and while the service's circuit breaker is open items are held
+    back until it lets a probe through.
+    '''
     _servicename = None
-    _image = None
+    _item = None
+    _data = None
     _format = None
     _path = None
+    _file = None
+    _token = None
+    _started = None
+    _sent = False
     _config = None
+    _queue = None
+    _breaker = None
+    _settings = None
 
-    def __init__(self, config):
+    def __init__(self, config, servicename, queue, thread=True):
         super(UploadWorker, self).__init__()
         self._config = config
+        self._servicename = servicename
+        self._queue = queue
+        self._breaker = mercury.resilience.breaker(config, servicename)
+        self._settings = mercury.resilience.Settings(config)
+        if not thread:
+            # Driven through handle() by an UploadEngine
+            return
         newthread = threading.Thread(target=self._worker)
         newthread.daemon = True
         newthread.start()
-        log.debug('Upload worker %s started.' % newthread.name)
+        log.debug('Upload worker %s started for %s.', newthread.name, servicename)
 
     def _worker(self):
         try:
             while True:
-                self._image, self._format, self._servicename = _upload.get()
-                self._image = img_unpickle(self._image)
-
-                log.debug('[%s] got something to upload, working with %s' % (
-                    threading.current_thread().name, self._image))
-
-                # check to see if specified service is in our list
-                if self._servicename not in mercury.services.registry:
-                    log.warning('Configured service %s is not loaded. Cannot upload.' % self._servicename)
-                    continue
-
-                # Open a temporary file and write the image to it
-                with tempfile.NamedTemporaryFile(
-                        suffix='.%s' % self._format.lower(),
-                        dir=self._config['tmp'],
-                        delete=False) as f:
-                    self._path = f.name
-                    log.debug('[%s] Saving temp file %s' % (
-                        threading.current_thread().name, self._path))
-                    self._image.save(f, self._format)
-
-                log.debug('Calling %s upload()' % self._servicename)
-                #TODO catch exceptions
-                mercury.services.registry[self._servicename].upload(self._config, self._path)
-
-                log.debug('[%s] Done with uploading image to %s' % (
-                    threading.current_thread().name, self._servicename))
-
-                log.debug('[%s] Removing temporary file %s' % (
-                    threading.current_thread().name, self._path))
-                os.remove(self._path)
+                self.handle(self._queue.get())
         except KeyboardInterrupt:
             #TODO may want to revisit this and allow process to finish gracefully
             return
+
+    def handle(self, item):
+        '''Upload one item, or put it back on the queue for later. Nothing
+        it raises gets out and ends the thread: an item that can't be dealt
+        with is given up on and journaled as failed.'''
+        # The item this worker is answerable for until it's parked or done
+        self._item = item
+        self._data, self._format = item.data, item.format
+        self._guarded(item, self._handle, item)
+
+    def asynchronous(self):
+        '''Whether the service builds its requests for mercury to send, so
+        they can go through a Reactor with start() and complete().'''
+        service = mercury.services.registry[self._servicename]
+        return hasattr(service, 'request') and hasattr(service, 'response')
+
+    def start(self, item, reactor, callback):
+        '''
+        Begin uploading item through reactor rather than on this thread.
+        Returns True once the request is out, when reactor calls
+        callback(response, error) from its own thread and what it was given
+        should be passed to complete() on a thread that can block. Otherwise
+        item has been dealt with already, as handle() would have.
+        '''
+        self._item = item
+        self._data, self._format = item.data, item.format
+        self._sent = False
+        self._guarded(item, self._start, item, reactor, callback)
+        return self._sent
+
+    def complete(self, response, error):
+        '''Finish the upload start() sent off.'''
+        item = self._item
+        self._guarded(item, self._complete, item, response, error)
+
+    def _guarded(self, item, function, *args):
+        try:
+            function(*args)
+        except Exception:
+            log.exception('[%s] Unable to handle %s, giving up on it.',
+                self._servicename, item.job['file'])
+            self._close()
+            self._abandon()
+
+    def _handle(self, item):
+        item = self._admit(item)
+        if item is None:
+            return
+        service = mercury.services.registry[self._servicename]
+        started = time.time()
+        try:
+            result = self._upload(service, item.job, item.budgeted)
+        except Exception as e:
+            self._finish(item, started, error=e)
+        else:
+            self._finish(item, started, result)
+
+    def _start(self, item, reactor, callback):
+        item = self._admit(item)
+        if item is None:
+            return
+        service = mercury.services.registry[self._servicename]
+        self._started = time.time()
+        try:
+            url, headers, body = self._request(service, item)
+        except Exception as e:
+            self._close()
+            self._release(item)
+            self._finish(item, self._started, error=e)
+            return
+        log.debug('[%s] Sending %s through the reactor', self._servicename, item.job['file'])
+        # The callback can come before request() returns
+        self._sent = True
+        reactor.request('POST', url, headers, body, callback)
+
+    def _complete(self, item, response, error):
+        self._close()
+        self._release(item)
+        service = mercury.services.registry[self._servicename]
+        try:
+            if error is not None:
+                raise error
+            result = service.response(self._config, response, self._token)
+        except Exception as e:
+            self._finish(item, self._started, error=e)
+        else:
+            self._finish(item, self._started, result)
+
+    def _request(self, service, item):
+        '''Open what's to be sent for item and have the service build the
+        request, returning (url, headers, body).'''
+        if self._data is not None:
+            self._file = io.BytesIO(self._data)
+            name = 'mercury.%s' % self._format.lower()
+        else:
+            self._file = open(item.job['file'], 'rb')
+            name = os.path.basename(item.job['file'])
+        # The token goes back to the service with the response
+        url, headers, body, self._token = service.request(self._config, name, self._file)
+        return url, headers, body
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _release(self, item):
+        # Sent or not, the data is done with
+        if item.budgeted and self._data is not None:
+            budget.release(len(self._data))
+        self._data = None
+
+    def _admit(self, item):
+        '''Return item ready to upload, read back in if it was spilled, or
+        None if it was put back to wait for the breaker.'''
+        if not self._breaker.allow():
+            # Shed while the service is down. The workers stay free,
+            # the budget goes to other services and the item comes
+            # back around for the probe.
+            mercury.metrics.count('mercury_uploads_total', service=self._servicename, result='shed')
+            self._park(item, self._breaker.retry_in())
+            return None
+
+        if item.spill:
+            item = self._item = self._unspill(item)
+        self._data, self._format = item.data, item.format
+        return item
+
+    def _finish(self, item, started, result=None, error=None):
+        '''Record how uploading item went, from the except clause that caught
+        error if there was one.'''
+        if error is not None:
+            if self._retry(item, error):
+                mercury.metrics.count('mercury_uploads_total', service=self._servicename, result='retry')
+                return
+            result = None
+        elif mercury.resilience.succeeded(result):
+            self._breaker.success()
+            mercury.dedup.record(self._config, item.job, self._servicename, result)
+        else:
+            log.error('[%s] Upload of %s came back without success: %s',
+                self._servicename, item.job['file'], result)
+            self._breaker.inconclusive()
+            result = None
+        mercury.metrics.observe('mercury_stage_seconds', time.time() - started,
+                                stage='upload', service=self._servicename)
+        if result:
+            mercury.metrics.count('mercury_uploads_total', service=self._servicename, result='success')
+            mercury.metrics.count('mercury_bytes_out_total', self._size(item), service=self._servicename)
+        else:
+            mercury.metrics.count('mercury_uploads_total', service=self._servicename, result='failure')
+        self._journal(item.job, result)
+        self._item = None
+        pending.done()
+
+    def _abandon(self):
+        '''Give back whatever the current item still holds and count it as
+        done, failed.'''
+        item, self._item = self._item, None
+        if item is None:
+            return
+        if item.budgeted and self._data is not None:
+            budget.release(len(self._data))
+        self._data = None
+        if item.spill:
+            try:
+                os.remove(item.spill)
+            except OSError:
+                pass
+        mercury.metrics.count('mercury_uploads_total', service=self._servicename, result='failure')
+        try:
+            self._journal(item.job, None)
+        except Exception:
+            log.exception('[%s] Unable to journal %s as failed', self._servicename, item.job['file'])
+        pending.done()
+
+    def _size(self, item):
+        if item.data is not None:
+            return len(item.data)
+        try:
+            return os.path.getsize(item.job['file'])
+        except OSError:
+            return 0
+
+    def _retry(self, item, e):
+        '''Schedule item to be tried again if e is worth retrying. Returns
+        False once it has failed for good.'''
+        kind = mercury.resilience.classify(e)
+        if kind != mercury.resilience.PERMANENT:
+            self._breaker.failure()
+        else:
+            self._breaker.inconclusive()
+        if item.attempt + 1 >= self._settings.attempts(kind):
+            log.exception('[%s] Giving up on %s after %i attempt(s), %s error',
+                item.service, item.job['file'], item.attempt + 1, kind)
+            return False
+        delay = mercury.resilience.backoff(item.attempt, self._settings.delay, self._settings.max_delay)
+        log.warning('[%s] Upload of %s failed (%s: %s), retrying in %.1fs',
+            item.service, item.job['file'], kind, e, delay)
+        # _upload has already released the data from the budget
+        self._park(item._replace(budgeted=False), delay, attempt=item.attempt + 1)
+        return True
+
+    def _park(self, item, delay, **changes):
+        '''
+        Put item back on the queue in delay seconds, with changes made to it.
+        Encoded data is written out to a temporary file to wait, and its
+        budget given back, so a service that's down can't pile up memory
+        while the pipeline carries on taking work for the others.
+        '''
+        if item.data is not None:
+            fd, path = tempfile.mkstemp(suffix='.%s' % item.format.lower(), dir=self._config['tmp'])
+            with os.fdopen(fd, 'wb') as f:
+                f.write(item.data)
+            if item.budgeted:
+                budget.release(len(item.data))
+            self._data = None
+            log.debug('[%s] Spilled %i bytes of %s to %s while it waits.',
+                item.service, len(item.data), item.job['file'], path)
+            item = item._replace(data=None, budgeted=False, spill=path)
+        mercury.resilience.later(delay, self._queue.put, item._replace(**changes))
+        self._item = None
+
+    def _unspill(self, item):
+        '''Read a parked item's data back in, charging it to the budget.'''
+        with open(item.spill, 'rb') as f:
+            data = f.read()
+        os.remove(item.spill)
+        budget.charge(len(data))
+        return item._replace(data=data, budgeted=True, spill=None)
+
+    def _journal(self, job, result):
+        if 'journal' not in self._config or not self._config['journal']:
+            return
+        if result:
+            self._config['journal'].done(job, self._servicename)
+        else:
+            self._config['journal'].failed(job, self._servicename)
+
+    def _upload(self, service, job, budgeted=True):
+        '''Upload the current item, returning whatever the service gave back.
+        budgeted data is released from the budget once it's been handed on.'''
+        # The original needed no changes, send the archived file as is
+        if self._data is None:
+            log.debug('[%s] got something to upload, working with archived file %s',
+                threading.current_thread().name, job['file'])
+            log.debug('Calling %s upload()', self._servicename)
+            result = service.upload(self._config, job['file'])
+            log.debug('[%s] Done with uploading image to %s',
+                threading.current_thread().name, self._servicename)
+            return result
+
+        log.debug('[%s] got something to upload, working with %i bytes of %s',
+            threading.current_thread().name, len(self._data), self._format)
+
+        # Post straight from memory where the service can
+        if hasattr(service, 'upload_bytes'):
+            log.debug('Calling %s upload_bytes()', self._servicename)
+            try:
+                result = service.upload_bytes(self._config, io.BytesIO(self._data), self._format)
+            finally:
+                if budgeted:
+                    budget.release(len(self._data))
+                self._data = None
+            log.debug('[%s] Done with uploading image to %s',
+                threading.current_thread().name, self._servicename)
+            return result
+
+        # Otherwise write the encoded image to a temporary file
+        try:
+            with tempfile.NamedTemporaryFile(
+                    suffix='.%s' % self._format.lower(),
+                    dir=self._config['tmp'],
+                    delete=False) as f:
+                self._path = f.name
+                log.debug('[%s] Saving temp file %s',
+                    threading.current_thread().name, self._path)
+                f.write(self._data)
+        finally:
+            if budgeted:
+                budget.release(len(self._data))
+            self._data = None
+
+        try:
+            log.debug('Calling %s upload()', self._servicename)
+            result = service.upload(self._config, self._path)
+            log.debug('[%s] Done with uploading image to %s',
+                threading.current_thread().name, self._servicename)
+        finally:
+            log.debug('[%s] Removing temporary file %s',
+                threading.current_thread().name, self._path)
+            os.remove(self._path)
+        return result
+
+
+class UploadEngine(object):
+    '''
+    Alternative to a thread per upload slot, enabled with upload_engine:
+    shared. One loop thread owns every service's waiting items and free slots
+    and is the only thing touching them, so there's no locking. It pairs
+    items with slots and hands them to a shared pool of upload_threads
+    threads (8 by default). A service's concurrency still caps how many of
+    its uploads run at once, but threads go to whichever service has work
+    instead of sitting idle on a quiet one. Waiting items, and the order
+    threads take them in across services, follow mercury.priority.
+
+    Services that build their own requests (sta.sh) don't hold a thread
+    while they upload: a thread prepares the request, a mercury.reactor
+    sends it and a thread picks up the response, so only their concurrency
+    limits them. The rest (imgur and tumblr, whose libraries block) keep a
+    thread for the whole upload, so no more than upload_threads of those
+    run at once whatever their concurrency.
+    '''
+    _config = None
+    _events = None
+    _work = None
+    _waiting = None
+    _slots = None
+    _order = None
+    _reactor = None
+
+    def __init__(self, config, threads):
+        super(UploadEngine, self).__init__()
+        self._config = config
+        self._events = Queue.Queue()
+        self._work = Queue.PriorityQueue()
+        self._waiting = {}
+        self._slots = {}
+        self._order = itertools.count()
+        newthread = threading.Thread(target=self._loop, name='upload-engine')
+        newthread.daemon = True
+        newthread.start()
+        for i in range(threads):
+            newthread = threading.Thread(target=self._run, name='upload-%i' % i)
+            newthread.daemon = True
+            newthread.start()
+        log.debug('Upload engine started with %i thread(s).', threads)
+
+    def add(self, service, concurrency):
+        '''Give service concurrency slots and return the queue its uploads
+        should be put on.'''
+        queue = _EngineQueue(self, service)
+        # Each slot is an UploadWorker without a thread of its own
+        slots = [UploadWorker(self._config, service, queue, thread=False) for i in range(concurrency)]
+        if slots and slots[0].asynchronous() and self._reactor is None:
+            self._reactor = mercury.reactor.Reactor(mercury.sessions.timeout(self._config))
+        self._events.put(('add', service, slots))
+        log.debug('Upload engine has %i slot(s) for %s', concurrency, service)
+        return queue
+
+    def put(self, service, item):
+        key = mercury.priority.upload_key(self._config, service, item)
+        self._events.put(('item', service, (key, next(self._order), item)))
+
+    def qsize(self, service):
+        '''Items waiting for one of service's slots.'''
+        return len(self._waiting.get(service, ()))
+
+    def _loop(self):
+        while True:
+            event, service, value = self._events.get()
+            if event == 'add':
+                self._slots[service] = value
+                self._waiting[service] = []
+            elif event == 'item':
+                heapq.heappush(self._waiting[service], value)
+            elif event == 'done':
+                self._slots[service].append(value)
+            while self._waiting[service] and self._slots[service]:
+                key, order, item = heapq.heappop(self._waiting[service])
+                self._work.put((key, order, self._upload, (service, self._slots[service].pop(), item)))
+
+    def _run(self):
+        while True:
+            key, order, function, args = self._work.get()
+            function(*args)
+
+    def _upload(self, service, slot, item):
+        sent = False
+        try:
+            if self._reactor is not None and slot.asynchronous():
+                sent = slot.start(item, self._reactor, self._responded(service, slot))
+            else:
+                slot.handle(item)
+        except Exception:
+            log.exception('[%s] Upload slot failed', service)
+        finally:
+            # A slot with a request out comes back once it's complete
+            if not sent:
+                self._events.put(('done', service, slot))
+
+    def _responded(self, service, slot):
+        '''Callback for the reactor, queueing the response ahead of any
+        upload not yet started.'''
+        def callback(response, error):
+            self._work.put((float('-inf'), next(self._order), self._complete, (service, slot, response, error)))
+        return callback
+
+    def _complete(self, service, slot, response, error):
+        try:
+            slot.complete(response, error)
+        except Exception:
+            log.exception('[%s] Upload slot failed', service)
+        finally:
+            self._events.put(('done', service, slot))
+
+
+class _EngineQueue(object):
+    '''Stands in for a service's upload queue when the engine is in use.'''
+    def __init__(self, engine, service):
+        self._engine = engine
+        self._service = service
+
+    def put(self, item):
+        self._engine.put(self._service, item)
+
+    def qsize(self):
+        return self._engine.qsize(self._service)
@@ -1,25 +1,173 @@
 '''
 logger.py
 consolidated logging module
+
+Records never touch the disk from the thread or process that logged them.
+The mercury logger's only handler puts them on a queue and a single listener
+thread in the main process writes them out, so the log file has one owner
+and workers never wait on it. Forked resize workers put their records on a
+process queue that feeds the same listener.
+
+Calls below the configured level return before doing anything, so pass
+arguments to the logging call rather than formatting the message yourself:
+    log.debug('Resized %s to %s', path, size)
+They're formatted when the record is queued, so what's logged is what they
+were at the time of the call.
 '''
+import atexit
 import logging
-import traceback
+import multiprocessing
+import os
+import Queue
 import sys
+import threading
+import traceback
 
 log = logging.getLogger('mercury')
+log.propagate = False
+
+_format = '%(asctime)s %(levelname)s [%(module)s]: %(message)s'
+
+# Records from this process. Created before anything forks, as is the
+# process queue children use instead.
+_records = Queue.Queue()
+_children = multiprocessing.Queue()
+_owner = os.getpid()
+_listener = None
+
+# Put on the record queue to end the writer thread
+_stop = object()
+
+
+class QueueHandler(logging.Handler):
+    '''Hands records to the listener instead of writing them.'''
+
+    def emit(self, record):
+        try:
+            record = self.prepare(record)
+            if os.getpid() != _owner:
+                _children.put(record)
+            elif _listener.stopped:
+                # Logged during shutdown, after the writer was stopped
+                _listener.handle(record)
+            else:
+                _records.put(record)
+        except Exception:
+            self.handleError(record)
+
+    def prepare(self, record):
+        # Format now, while the arguments are as they were at the call. Only
+        # the message is sent on, as whatever was passed in may not pickle.
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class QueueListener(object):
+    '''Writes queued records to handlers from one thread.'''
+    _handlers = None
+    _lock = None
+    _writer = None
+    _forwarder = None
+    _stopped = False
+
+    def __init__(self, handlers):
+        super(QueueListener, self).__init__()
+        self._handlers = handlers
+        self._lock = threading.Lock()
+        self._writer = threading.Thread(target=self._run, name='log-writer')
+        self._writer.daemon = True
+        self._writer.start()
+        self._forwarder = threading.Thread(target=self._forward, name='log-children')
+        self._forwarder.daemon = True
+        self._forwarder.start()
 
-logging.basicConfig(
-    format='%(asctime)s %(levelname)s [%(module)s]: %(message)s',
-    #datefmt='%Y-%m-%d %H:%M:%S',
-    #TODO don't hardcode this
-    filename='out.log',
-    level=logging.DEBUG
-)
+    def _forward(self):
+        while True:
+            record = _children.get()
+            if record is None:
+                return
+            _records.put(record)
+
+    def _run(self):
+        while True:
+            record = _records.get()
+            if record is _stop:
+                return
+            self.handle(record)
+
+    def handle(self, record):
+        with self._lock:
+            for handler in self._handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def stop(self):
+        '''Write out everything logged so far and end both threads. Anything
+        logged after is written straight away by the caller.'''
+        _children.put(None)
+        self._forwarder.join()
+        _records.put(_stop)
+        self._writer.join()
+        self._stopped = True
+        with self._lock:
+            for handler in self._handlers:
+                handler.flush()
+
+    def replace(self, handlers):
+        '''Swap in new handlers, closing the old ones.'''
+        with self._lock:
+            old, self._handlers = self._handlers, handlers
+        for handler in old:
+            handler.close()
+
+
+def _handler(destination):
+    if destination in ('-', 'stderr'):
+        handler = logging.StreamHandler(sys.stderr)
+    elif destination == 'stdout':
+        handler = logging.StreamHandler(sys.stdout)
+    else:
+        handler = logging.FileHandler(os.path.expanduser(destination), delay=True)
+    handler.setFormatter(logging.Formatter(_format))
+    return handler
+
+
+def setup(config):
+    '''
+    Apply log_level and log_file from the config. log_file may be a path or
+    stderr/stdout. Call before starting worker processes so they inherit the
+    level.
+    '''
+    level = 'DEBUG'
+    if 'log_level' in config and config['log_level']:
+        level = str(config['log_level']).upper()
+    destination = 'out.log'
+    if 'log_file' in config and config['log_file']:
+        destination = config['log_file']
+    if not isinstance(logging.getLevelName(level), int):
+        log.warning('Unknown log_level %s, using DEBUG', level)
+        level = 'DEBUG'
+    log.setLevel(level)
+    _listener.replace([_handler(destination)])
+
+
+def shutdown():
+    '''Write out everything queued and stop the listener, at exit.'''
+    if _listener and os.getpid() == _owner and not _listener.stopped:
+        _listener.stop()
 
 
 def custom_exception_hook(*args):
     formatted = "".join(traceback.format_exception(*args))
-    logging.critical("Unhandled exception\n%s" % formatted)
+    log.critical("Unhandled exception\n%s", formatted)
 sys.excepthook = custom_exception_hook
 
 
@@ -27,3 +175,10 @@ def getLogger():
     '''Returns the shared logging object generated by this module for use
     throughout the project'''
     return log
+
+
+# Defaults until setup() applies the config
+log.setLevel(logging.DEBUG)
+log.addHandler(QueueHandler())
+_listener = QueueListener([_handler('out.log')])
+atexit.register(shutdown)
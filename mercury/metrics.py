@@ -0,0 +1,212 @@
+'''
+metrics.py
+Counters, timing histograms and gauges for the pipeline, exposed as
+Prometheus text over HTTP on metrics_port and/or written to metrics_file
+every metrics_interval seconds.
+
+Nothing is recorded unless one of those is configured. Resize workers are
+separate processes, so what they record is sent back over a queue and added
+up in the main process with everything else.
+'''
+import BaseHTTPServer
+import bisect
+import multiprocessing
+import os
+import threading
+import time
+
+import mercury.log
+
+log = mercury.log.getLogger()
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Created at import so forked workers share it with the main process
+_reports = multiprocessing.Queue()
+
+_enabled = False
+_owner = None
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+
+
+def setup(config):
+    '''Start collecting if metrics are configured. Call before any worker
+    processes are started so they know to report back.'''
+    global _enabled
+    global _owner
+    port = config['metrics_port'] if 'metrics_port' in config else None
+    path = config['metrics_file'] if 'metrics_file' in config else None
+    if not port and not path:
+        return
+    _enabled = True
+    _owner = os.getpid()
+
+    newthread = threading.Thread(target=_collect, name='metrics')
+    newthread.daemon = True
+    newthread.start()
+
+    if port:
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', int(port)), _Handler)
+        newthread = threading.Thread(target=server.serve_forever, name='metrics-http')
+        newthread.daemon = True
+        newthread.start()
+        log.info('Serving metrics on http://127.0.0.1:%i/metrics', int(port))
+    if path:
+        interval = 15.0
+        if 'metrics_interval' in config and config['metrics_interval']:
+            interval = float(config['metrics_interval'])
+        newthread = threading.Thread(target=_write, args=(path, interval), name='metrics-file')
+        newthread.daemon = True
+        newthread.start()
+        log.info('Writing metrics to %s every %gs', path, interval)
+
+
+def count(name, n=1, **labels):
+    '''Add n to the counter name.'''
+    if _enabled:
+        _record('counter', name, labels, n)
+
+
+def observe(name, value, **labels):
+    '''Add a value, in seconds, to the histogram name.'''
+    if _enabled:
+        _record('histogram', name, labels, value)
+
+
+def timer(name, **labels):
+    '''Context manager observing how long its body took.'''
+    return _Timer(name, labels)
+
+
+def gauge(name, fn, **labels):
+    '''Report whatever fn returns as name each time metrics are read. Only
+    meaningful in the main process.'''
+    with _lock:
+        _gauges[(name, _key(labels))] = fn
+
+
+class _Timer(object):
+    def __init__(self, name, labels):
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self._name, time.time() - self._start, **self._labels)
+        return False
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _record(kind, name, labels, value):
+    if os.getpid() == _owner:
+        _apply(kind, name, _key(labels), value)
+    else:
+        _reports.put((kind, name, _key(labels), value))
+
+
+def _apply(kind, name, key, value):
+    with _lock:
+        if kind == 'counter':
+            _counters[(name, key)] = _counters.get((name, key), 0) + value
+        else:
+            h = _histograms.get((name, key))
+            if h is None:
+                # Per bucket counts, then +Inf, sum and count
+                h = _histograms[(name, key)] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+            h[bisect.bisect_left(BUCKETS, value)] += 1
+            h[-2] += value
+            h[-1] += 1
+
+
+def _collect():
+    while True:
+        kind, name, key, value = _reports.get()
+        _apply(kind, name, key, value)
+
+
+def render():
+    '''Return every metric in the Prometheus text format.'''
+    lines = []
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((k, list(v)) for k, v in _histograms.items())
+        gauges = sorted(_gauges.items())
+
+    typed = set()
+    for (name, key), value in counters:
+        _type(lines, typed, name, 'counter')
+        lines.append('%s%s %s' % (name, _labels(key), _number(value)))
+    for (name, key), h in histograms:
+        _type(lines, typed, name, 'histogram')
+        cumulative = 0
+        for bound, n in zip(BUCKETS + ('+Inf',), h):
+            cumulative += n
+            le = bound if bound == '+Inf' else _number(bound)
+            lines.append('%s_bucket%s %i' % (name, _labels(key + (('le', le),)), cumulative))
+        lines.append('%s_sum%s %s' % (name, _labels(key), _number(h[-2])))
+        lines.append('%s_count%s %i' % (name, _labels(key), h[-1]))
+    for (name, key), fn in gauges:
+        try:
+            value = fn()
+        except Exception:
+            # multiprocessing queues can't report their size on some platforms
+            continue
+        _type(lines, typed, name, 'gauge')
+        lines.append('%s%s %s' % (name, _labels(key), _number(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _type(lines, typed, name, kind):
+    if name not in typed:
+        typed.add(name)
+        lines.append('# TYPE %s %s' % (name, kind))
+
+
+def _labels(key):
+    if not key:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                             for k, v in key)
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _write(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            with open(path + '.tmp', 'w') as f:
+                f.write(render())
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            log.warning('Unable to write metrics to %s', path)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('metrics: ' + format, *args)
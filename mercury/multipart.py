@@ -0,0 +1,98 @@
+'''
+multipart.py
+multipart/form-data bodies that stream their file part in fixed size chunks
+rather than being built in memory, so an upload costs a chunk of memory no
+matter how big the image is.
+'''
+import mimetypes
+import os
+import uuid
+
+
+class MultipartStream(object):
+    '''
+    A file-like body for requests holding fields followed by one file part.
+    f is read from its current position to the end and must be seekable, so
+    the body can be rewound and sent again. Pass it as data= along with
+    content_type as the Content-Type header; the length is known up front so
+    it's sent with a Content-Length rather than chunked.
+    '''
+    _parts = None
+    _length = None
+    _index = 0
+    _offset = 0
+    _chunk = None
+    _boundary = None
+
+    def __init__(self, name, filename, f, fields=None, chunk=64 * 1024):
+        super(MultipartStream, self).__init__()
+        self._boundary = uuid.uuid4().hex
+        self._chunk = chunk
+
+        head = []
+        for key, value in sorted((fields or {}).items()):
+            head.append('--%s\r\n' % self._boundary)
+            head.append('Content-Disposition: form-data; name="%s"\r\n\r\n' % key)
+            head.append('%s\r\n' % _encode(value))
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        head.append('--%s\r\n' % self._boundary)
+        head.append('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (
+            name, _encode(filename).replace('"', '%22')))
+        head.append('Content-Type: %s\r\n\r\n' % mimetype)
+        head = ''.join(head)
+        tail = '\r\n--%s--\r\n' % self._boundary
+
+        start = f.tell()
+        f.seek(0, os.SEEK_END)
+        size = f.tell() - start
+        f.seek(start)
+        self._parts = [(head, None, len(head)), (f, start, size), (tail, None, len(tail))]
+        self._length = len(head) + size + len(tail)
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self._boundary
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        while True:
+            data = self.read(self._chunk)
+            if not data:
+                return
+            yield data
+
+    def read(self, size=-1):
+        '''Return up to size bytes, never more than one chunk at a time.'''
+        if size is None or size < 0 or size > self._chunk:
+            size = self._chunk
+        out = []
+        while size > 0 and self._index < len(self._parts):
+            part, start, length = self._parts[self._index]
+            count = min(size, length - self._offset)
+            if start is None:
+                data = part[self._offset:self._offset + count]
+            else:
+                part.seek(start + self._offset)
+                data = part.read(count)
+                if len(data) < count:
+                    raise IOError('File shrank while it was being uploaded')
+            out.append(data)
+            size -= count
+            self._offset += count
+            if self._offset >= length:
+                self._index += 1
+                self._offset = 0
+        return ''.join(out)
+
+    def rewind(self):
+        '''Start over from the first byte, for sending the body again.'''
+        self._index = 0
+        self._offset = 0
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
@@ -0,0 +1,105 @@
+'''
+priority.py
+Shortest job first ordering, with aging, for the dispatch, resize and upload
+queues.
+
+Work is keyed when it's queued: the time it was queued, plus a rough estimate
+of how long it will take capped at schedule_max_delay seconds, less its
+priority in seconds. The lowest key goes first. Small jobs so get ahead of
+big ones queued around the same time, but nothing can be overtaken by work
+queued more than schedule_max_delay seconds after it, so a big job ages its
+way to the front instead of starving. A schedule_max_delay of 0 is FIFO.
+
+Priority comes from priority_folders, mapping folders (absolute, or relative
+to the watched folder) to the priority of files dropped in them, and from a
+service's own priority setting for its uploads. Folders listed are watched
+alongside the watched folder. Negative priorities send work to the back, as
+for a bulk import.
+'''
+import heapq
+import itertools
+import os.path
+import Queue
+import time
+
+# Rough rates work goes at, for turning its size into seconds. Only how
+# jobs compare matters, not how accurate these are.
+RESIZE_RATE = 50 * 2 ** 20   # decoded bytes a second
+UPLOAD_RATE = 2 * 2 ** 20    # file bytes a second
+
+
+class PriorityQueue(Queue.Queue):
+    '''A Queue.Queue handing items out lowest key first, key(item) being
+    worked out as each is put.'''
+    def __init__(self, key, maxsize=0):
+        self._key = key
+        Queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.queue = []
+        self._order = itertools.count()
+
+    def _qsize(self, len=len):
+        return len(self.queue)
+
+    def _put(self, item):
+        heapq.heappush(self.queue, (self._key(item), next(self._order), item))
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
+
+
+def key(config, estimate, priority=0):
+    '''Return the key for work queued now that should take estimate seconds.'''
+    max_delay = 60.0
+    if 'schedule_max_delay' in config and config['schedule_max_delay'] is not None:
+        max_delay = float(config['schedule_max_delay'])
+    return time.time() + min(estimate, max_delay) - priority
+
+
+def folders(config):
+    '''Return priority_folders as a dict of absolute paths to priorities.'''
+    if 'priority_folders' not in config or not config['priority_folders']:
+        return {}
+    watched = os.path.abspath(config['watched_folder'])
+    return dict((os.path.normpath(os.path.join(watched, os.path.expanduser(str(f)))), float(p))
+                for f, p in config['priority_folders'].items())
+
+
+def folder_priority(config, path):
+    '''Priority of a file at path, going by the folder it's in.'''
+    return folders(config).get(os.path.dirname(os.path.abspath(path)), 0.0)
+
+
+def service_priority(config, service):
+    if service in config['services'] and config['services'][service]:
+        if 'priority' in config['services'][service] and config['services'][service]['priority']:
+            return float(config['services'][service]['priority'])
+    return 0.0
+
+
+def dispatch_key(config, path):
+    '''Key for a path waiting to be dispatched, going by its file size.'''
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    return key(config, size / float(UPLOAD_RATE), folder_priority(config, path))
+
+
+def resize_key(config, job, priority=0):
+    '''Key for a resize job, going by the pixels to decode.'''
+    return key(config, job['cost'] / float(RESIZE_RATE), job.get('priority', 0) + priority)
+
+
+def upload_key(config, service, item):
+    '''Key for an Upload on service's queue, going by the bytes to send.'''
+    if item.data is not None:
+        size = len(item.data)
+    else:
+        try:
+            size = os.path.getsize(item.spill or item.job['file'])
+        except OSError:
+            size = 0
+    return key(config, size / float(UPLOAD_RATE),
+               item.job.get('priority', 0) + service_priority(config, service))
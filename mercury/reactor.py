@@ -0,0 +1,561 @@
+'''
+reactor.py
+One thread making any number of HTTP requests at once over non-blocking
+sockets, for the upload engine. Python 2 has no asyncio, so this is a small
+poll loop of its own: each request steps through connecting, the TLS
+handshake, sending and reading the response as its socket becomes ready.
+Connections are kept alive and reused per host.
+
+Only what uploads need is covered: HTTP/1.1 over TLS or plain TCP, a body
+given as a string or a file-like object with read() and len() (and rewind()
+if it may need sending again), and responses framed by Content-Length,
+chunked encoding or the connection closing. There's no proxy support. Host
+names are resolved by the thread calling request(), never by the loop.
+'''
+import collections
+import errno
+import fcntl
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+import urlparse
+
+import requests
+import requests.certs
+import requests.models
+import requests.structures
+import requests.utils
+
+import mercury.log
+
+log = mercury.log.getLogger()
+
+_chunk = 64 * 1024
+# Seconds an unused kept-alive connection is held on to
+_idle_timeout = 30.0
+# Seconds a host name lookup is reused for
+_dns_ttl = 60.0
+# Longest response head taken before giving up on the server
+_max_head = 64 * 1024
+
+
+class Reactor(object):
+    '''
+    Runs requests on a thread of its own. request() can be called from any
+    thread; callbacks are called on the reactor's thread, so they should only
+    hand the outcome on rather than doing any work themselves. A request
+    fails with requests.Timeout once timeout seconds pass without any
+    progress on it.
+    '''
+    _timeout = None
+    _poll = None
+    _wake = None
+    _calls = None
+    _lock = None
+    _handlers = None
+    _idle = None
+    _addresses = None
+    _context = None
+
+    def __init__(self, timeout=60.0):
+        super(Reactor, self).__init__()
+        self._timeout = timeout
+        self._poll = select.poll()
+        self._wake = os.pipe()
+        for fd in self._wake:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poll.register(self._wake[0], select.POLLIN)
+        self._calls = collections.deque()
+        self._lock = threading.Lock()
+        self._handlers = {}
+        self._idle = {}
+        self._addresses = {}
+        self._context = ssl.create_default_context(cafile=requests.certs.where())
+
+        newthread = threading.Thread(target=self._run, name='reactor')
+        newthread.daemon = True
+        newthread.start()
+        log.debug('Reactor started with a %ss timeout.', timeout)
+
+    def request(self, method, url, headers, body, callback):
+        '''Start a request. callback is called with (response, None) once a
+        response has been read, whatever its status, or (None, exception) if
+        there wasn't one. response is a requests.Response.'''
+        parts = urlparse.urlsplit(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        try:
+            address = self._resolve(parts.hostname, port)
+        except socket.error as e:
+            callback(None, requests.ConnectionError(e))
+            return
+        exchange = _Exchange(self, (parts.scheme, parts.hostname, port), address, url,
+                             method, path, headers, body, callback)
+        self.call(exchange.start)
+
+    def call(self, function, *args):
+        '''Run function(*args) on the reactor's thread.'''
+        with self._lock:
+            self._calls.append((function, args))
+        try:
+            os.write(self._wake[1], 'x')
+        except OSError as e:
+            # Already full, so the loop has a wakeup waiting anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _resolve(self, host, port):
+        now = time.time()
+        with self._lock:
+            if (host, port) in self._addresses and self._addresses[(host, port)][1] > now:
+                return self._addresses[(host, port)][0]
+        family, kind, proto, name, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+        with self._lock:
+            self._addresses[(host, port)] = ((family, address), now + _dns_ttl)
+        return (family, address)
+
+    def watch(self, fd, handler, events):
+        if fd in self._handlers:
+            self._poll.modify(fd, events)
+        else:
+            self._poll.register(fd, events)
+        self._handlers[fd] = handler
+
+    def unwatch(self, fd):
+        if self._handlers.pop(fd, None) is not None:
+            self._poll.unregister(fd)
+
+    def connection(self, key):
+        '''Return a kept-alive connection to key, or None.'''
+        while self._idle.get(key):
+            idle = self._idle[key].pop()
+            self.unwatch(idle.sock.fileno())
+            if idle.alive():
+                return idle.sock
+            idle.close()
+        return None
+
+    def keep(self, key, sock):
+        '''Hold on to sock for the next request to key.'''
+        idle = _Idle(self, key, sock)
+        self._idle.setdefault(key, []).append(idle)
+        self.watch(sock.fileno(), idle, select.POLLIN)
+
+    def drop(self, idle):
+        if idle in self._idle.get(idle.key, ()):
+            self._idle[idle.key].remove(idle)
+        self.unwatch(idle.sock.fileno())
+        idle.close()
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @property
+    def context(self):
+        return self._context
+
+    def _run(self):
+        while True:
+            # Nothing to time out means nothing to wake up for but events
+            wait = 500 if self._handlers else None
+            try:
+                events = self._poll.poll(wait)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wake[0]:
+                    self._drain()
+                elif fd in self._handlers:
+                    self._step(self._handlers[fd].ready, event)
+            with self._lock:
+                calls, self._calls = self._calls, collections.deque()
+            for function, args in calls:
+                self._step(function, *args)
+            now = time.time()
+            for handler in self._handlers.values():
+                self._step(handler.expire, now)
+
+    def _drain(self):
+        try:
+            while os.read(self._wake[0], 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _step(self, function, *args):
+        try:
+            function(*args)
+        except Exception:
+            log.exception('Reactor call failed')
+
+
+class _Idle(object):
+    '''A kept-alive connection waiting for its next request. Anything
+    arriving on it meanwhile means the server is closing it.'''
+    def __init__(self, reactor, key, sock):
+        self.reactor = reactor
+        self.key = key
+        self.sock = sock
+        self.since = time.time()
+
+    def alive(self):
+        return time.time() - self.since < _idle_timeout
+
+    def ready(self, event):
+        self.reactor.drop(self)
+
+    def expire(self, now):
+        if not self.alive():
+            self.reactor.drop(self)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class _Exchange(object):
+    '''One request and its response, on a new or kept-alive connection.'''
+    def __init__(self, reactor, key, address, url, method, path, headers, body, callback):
+        self._reactor = reactor
+        self._key = key
+        self._address = address
+        self._url = url
+        self._method = method
+        self._path = path
+        self._headers = headers
+        self._body = body
+        self._callback = callback
+        self._sock = None
+        self._fd = None
+        self._reused = False
+        self._state = None
+        self._out = ''
+        self._sent = False
+        self._parser = None
+        self._deadline = None
+
+    def start(self):
+        self._safely(self._start)
+
+    def ready(self, event):
+        self._progress()
+        self._safely(self._ready)
+
+    def _safely(self, function):
+        try:
+            function()
+        except ssl.CertificateError as e:
+            self._fail(requests.exceptions.SSLError(e))
+        except (socket.error, ssl.SSLError) as e:
+            self._failed(e)
+
+    def _start(self):
+        self._progress()
+        self._parser = _Parser(self._method)
+        self._sock = self._reactor.connection(self._key)
+        if self._sock:
+            self._reused = True
+            self._fd = self._sock.fileno()
+            self._begin_send()
+            return
+        family, address = self._address
+        self._sock = socket.socket(family, socket.SOCK_STREAM)
+        self._sock.setblocking(False)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._fd = self._sock.fileno()
+        self._state = 'connect'
+        error = self._sock.connect_ex(address)
+        if error in (0, errno.EISCONN):
+            self._connected()
+        elif error in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self._reactor.watch(self._fd, self, select.POLLOUT)
+        else:
+            raise socket.error(error, os.strerror(error))
+
+    def _ready(self):
+        if self._state == 'connect':
+            error = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                raise socket.error(error, os.strerror(error))
+            self._connected()
+        elif self._state == 'handshake':
+            self._handshake()
+        elif self._state == 'send':
+            self._send()
+        elif self._state == 'receive':
+            self._receive()
+
+    def expire(self, now):
+        if self._state != 'done' and now > self._deadline:
+            if self._state == 'connect':
+                self._fail(requests.ConnectTimeout('Timed out connecting to %s' % self._key[1]))
+            else:
+                self._fail(requests.ReadTimeout('Timed out waiting on %s' % self._key[1]))
+
+    def _progress(self):
+        self._deadline = time.time() + self._reactor.timeout
+
+    def _connected(self):
+        if self._key[0] != 'https':
+            self._begin_send()
+            return
+        self._sock = self._reactor.context.wrap_socket(
+            self._sock, server_hostname=self._key[1], do_handshake_on_connect=False)
+        self._sock.setblocking(False)
+        self._state = 'handshake'
+        self._handshake()
+
+    def _handshake(self):
+        try:
+            self._sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self._reactor.watch(self._fd, self, select.POLLIN)
+            return
+        except ssl.SSLWantWriteError:
+            self._reactor.watch(self._fd, self, select.POLLOUT)
+            return
+        self._begin_send()
+
+    def _begin_send(self):
+        head = ['%s %s HTTP/1.1' % (self._method, self._path), 'Host: %s' % self._key[1],
+                'Accept-Encoding: identity', 'Content-Length: %i' % len(self._body)]
+        for name, value in sorted(self._headers.items()):
+            head.append('%s: %s' % (name, value))
+        self._out = '\r\n'.join(head) + '\r\n\r\n'
+        if isinstance(self._body, str):
+            self._out += self._body
+        self._state = 'send'
+        self._send()
+
+    def _send(self):
+        # A few chunks at a time so one big upload doesn't hold up the others
+        for i in range(16):
+            if not self._out:
+                if isinstance(self._body, str) or self._sent:
+                    self._state = 'receive'
+                    self._reactor.watch(self._fd, self, select.POLLIN)
+                    self._receive()
+                    return
+                self._out = self._body.read(_chunk)
+                if not self._out:
+                    self._sent = True
+                    continue
+            try:
+                count = self._sock.send(self._out)
+            except ssl.SSLWantWriteError:
+                break
+            except ssl.SSLWantReadError:
+                self._reactor.watch(self._fd, self, select.POLLIN)
+                return
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                break
+            self._out = self._out[count:]
+        self._reactor.watch(self._fd, self, select.POLLOUT)
+
+    def _receive(self):
+        while True:
+            try:
+                data = self._sock.recv(_chunk)
+            except ssl.SSLWantReadError:
+                return
+            except ssl.SSLWantWriteError:
+                self._reactor.watch(self._fd, self, select.POLLOUT)
+                return
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                return
+            if not data:
+                self._parser.eof()
+                if not self._parser.done:
+                    raise socket.error(errno.ECONNRESET, 'Connection closed part way through the response')
+            else:
+                self._parser.feed(data)
+            if self._parser.done:
+                self._finish()
+                return
+
+    def _finish(self):
+        self._state = 'done'
+        self._reactor.unwatch(self._fd)
+        if self._parser.reusable():
+            self._reactor.keep(self._key, self._sock)
+        else:
+            self._close()
+        response = requests.models.Response()
+        response.status_code = self._parser.status
+        response.reason = self._parser.reason
+        response.headers = self._parser.headers
+        response._content = ''.join(self._parser.body)
+        response.url = self._url
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        self._callback(response, None)
+
+    def _failed(self, e):
+        # A kept-alive connection the server had already given up on. Try
+        # once more on a new one if nothing of the response came back.
+        if self._reused and not self._parser.started:
+            if isinstance(self._body, str) or hasattr(self._body, 'rewind'):
+                log.debug('Kept-alive connection to %s went away, reconnecting.', self._key[1])
+                self._reactor.unwatch(self._fd)
+                self._close()
+                if not isinstance(self._body, str):
+                    self._body.rewind()
+                self._reused = False
+                self._sent = False
+                self._out = ''
+                self._reactor.call(self.start)
+                return
+        self._fail(requests.ConnectionError(e))
+
+    def _fail(self, e):
+        if self._state == 'done':
+            return
+        self._state = 'done'
+        self._reactor.unwatch(self._fd)
+        self._close()
+        self._callback(None, e)
+
+    def _close(self):
+        try:
+            self._sock.close()
+        except socket.error:
+            pass
+
+
+class _Parser(object):
+    '''Reads an HTTP/1.1 response fed to it in pieces.'''
+    def __init__(self, method):
+        self._method = method
+        self._buffer = ''
+        self._length = None
+        self._chunked = False
+        self._left = None
+        self._trailers = False
+        self.started = False
+        self.version = None
+        self.status = None
+        self.reason = None
+        self.headers = None
+        self.body = []
+        self.done = False
+
+    def feed(self, data):
+        self.started = True
+        self._buffer += data
+        while not self.done:
+            if self.status is None:
+                if not self._head():
+                    return
+            elif self._chunked:
+                if not self._chunk():
+                    return
+            elif self._length is None:
+                # Runs until the connection closes
+                self.body.append(self._buffer)
+                self._buffer = ''
+                return
+            else:
+                take = self._buffer[:self._length]
+                self._buffer = self._buffer[len(take):]
+                self._length -= len(take)
+                self.body.append(take)
+                if self._length:
+                    return
+                self.done = True
+
+    def eof(self):
+        if self.status is not None and self._length is None and not self._chunked:
+            self.done = True
+
+    def reusable(self):
+        '''Whether the connection can carry another request.'''
+        return self.version == 'HTTP/1.1' and not self._buffer and \
+            (self._chunked or self._length is not None) and \
+            self.headers.get('connection', '').lower() != 'close'
+
+    def _head(self):
+        end = self._buffer.find('\r\n\r\n')
+        if end < 0:
+            if len(self._buffer) > _max_head:
+                raise socket.error(errno.EPROTO, 'Response head too long')
+            return False
+        lines = self._buffer[:end].split('\r\n')
+        self._buffer = self._buffer[end + 4:]
+        status = lines[0].split(' ', 2)
+        try:
+            self.version, code = status[0], int(status[1])
+        except (IndexError, ValueError):
+            raise socket.error(errno.EPROTO, 'Malformed status line %r' % lines[0][:100])
+        if 100 <= code < 200:
+            # Interim response, the real one follows
+            return True
+        self.status = code
+        self.reason = status[2] if len(status) > 2 else ''
+        self.headers = requests.structures.CaseInsensitiveDict()
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                continue
+            name, value = name.strip(), value.strip()
+            self.headers[name] = self.headers[name] + ', ' + value if name in self.headers else value
+        if self._method == 'HEAD' or code in (204, 304):
+            self._length = 0
+        elif 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self._chunked = True
+        elif 'content-length' in self.headers:
+            try:
+                self._length = int(self.headers['content-length'])
+            except ValueError:
+                raise socket.error(errno.EPROTO, 'Malformed Content-Length')
+        if self._length == 0:
+            self.done = True
+        return True
+
+    def _chunk(self):
+        if self._trailers:
+            end = self._buffer.find('\r\n')
+            if end < 0:
+                return False
+            line, self._buffer = self._buffer[:end], self._buffer[end + 2:]
+            if not line:
+                self.done = True
+            return True
+        if self._left is None:
+            end = self._buffer.find('\r\n')
+            if end < 0:
+                return False
+            line, self._buffer = self._buffer[:end], self._buffer[end + 2:]
+            try:
+                size = int(line.split(';')[0].strip(), 16)
+            except ValueError:
+                raise socket.error(errno.EPROTO, 'Malformed chunk size')
+            if size:
+                self._left = size
+            else:
+                self._trailers = True
+            return True
+        if self._left:
+            take = self._buffer[:self._left]
+            if not take:
+                return False
+            self._buffer = self._buffer[len(take):]
+            self._left -= len(take)
+            self.body.append(take)
+            return True
+        if len(self._buffer) < 2:
+            return False
+        self._buffer = self._buffer[2:]
+        self._left = None
+        return True
@@ -0,0 +1,277 @@
+'''
+resilience.py
+Keeps a failing service from taking the upload workers down with it.
+
+Errors from service calls are sorted into transient (worth trying again
+later), auth (credentials were refused, which a token refresh may fix) and
+permanent (trying again won't help). Retries wait out an exponential backoff
+with full jitter on a shared timer thread instead of in the worker, and a
+circuit breaker per service stops sending uploads to a host that keeps
+failing until a single probe shows it's back.
+'''
+import heapq
+import httplib
+import itertools
+import random
+import socket
+import threading
+import time
+
+import requests
+
+import mercury.log
+
+log = mercury.log.getLogger()
+
+TRANSIENT = 'transient'
+AUTH = 'auth'
+PERMANENT = 'permanent'
+
+
+class UploadError(Exception):
+    '''Raised by services to say how an upload failed.'''
+    kind = PERMANENT
+
+
+class TransientError(UploadError):
+    kind = TRANSIENT
+
+
+class AuthError(UploadError):
+    kind = AUTH
+
+
+class PermanentError(UploadError):
+    kind = PERMANENT
+
+
+def error_for_status(status, message):
+    '''Return the UploadError matching an HTTP status code.'''
+    return {TRANSIENT: TransientError, AUTH: AuthError, PERMANENT: PermanentError}[
+        _status_kind(status)](message)
+
+
+def _status_kind(status):
+    if status in (401, 403):
+        return AUTH
+    if status in (408, 429) or status >= 500:
+        return TRANSIENT
+    return PERMANENT
+
+
+def classify(e):
+    '''Return TRANSIENT, AUTH or PERMANENT for an exception from a service.'''
+    if isinstance(e, UploadError):
+        return e.kind
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return _status_kind(e.response.status_code)
+    if isinstance(e, (requests.ConnectionError, requests.Timeout,
+                      socket.error, httplib.HTTPException)):
+        return TRANSIENT
+    return PERMANENT
+
+
+def succeeded(result):
+    '''Whether what a service's upload returned is a real success. Services
+    raise on failure, but an error payload that slipped through, an HTTP
+    error response or nothing at all doesn't count.'''
+    if not result:
+        return False
+    status = getattr(result, 'status_code', None)
+    if status is not None and status >= 400:
+        return False
+    body = result
+    if hasattr(result, 'json'):
+        try:
+            body = result.json()
+        except ValueError:
+            return True
+    if isinstance(body, dict):
+        if 'error' in body or 'errors' in body or body.get('status') == 'error':
+            return False
+        meta = body.get('meta')
+        if isinstance(meta, dict) and meta.get('status'):
+            try:
+                if int(meta['status']) >= 400:
+                    return False
+            except (TypeError, ValueError):
+                # A status that isn't a number isn't a success either
+                return False
+    return True
+
+
+def backoff(attempt, base, cap):
+    '''Seconds to wait before retry number attempt, counting from 0. Full
+    jitter spreads out retries from uploads that failed together.'''
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class Settings(object):
+    '''Retry and breaker settings read from the config.'''
+    limit = 5
+    delay = 2.0
+    max_delay = 300.0
+    auth_limit = 2
+    threshold = 5
+    reset = 60.0
+
+    def __init__(self, config):
+        super(Settings, self).__init__()
+        if 'retry_limit' in config and config['retry_limit'] is not None:
+            self.limit = max(1, int(config['retry_limit']))
+        if 'retry_delay' in config and config['retry_delay']:
+            self.delay = float(config['retry_delay'])
+        if 'retry_max_delay' in config and config['retry_max_delay']:
+            self.max_delay = float(config['retry_max_delay'])
+        if 'breaker_threshold' in config and config['breaker_threshold']:
+            self.threshold = int(config['breaker_threshold'])
+        if 'breaker_reset' in config and config['breaker_reset']:
+            self.reset = float(config['breaker_reset'])
+
+    def attempts(self, kind):
+        '''How many times an upload failing this way is tried in total.'''
+        if kind == TRANSIENT:
+            return self.limit
+        if kind == AUTH:
+            return min(self.limit, self.auth_limit)
+        return 1
+
+
+class CircuitBreaker(object):
+    '''
+    Closed, uploads go through. After threshold failures in a row it opens
+    and sheds everything for reset seconds, then lets one probe through. The
+    probe succeeding closes it again, failing opens it for another period.
+    '''
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    _name = None
+    _threshold = None
+    _reset = None
+    _state = CLOSED
+    _failures = 0
+    _opened = 0
+    _lock = None
+
+    def __init__(self, name, threshold, reset):
+        super(CircuitBreaker, self).__init__()
+        self._name = name
+        self._threshold = threshold
+        self._reset = reset
+        self._lock = threading.Lock()
+
+    def allow(self):
+        '''Return True if an upload may go ahead now.'''
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.time() - self._opened >= self._reset:
+                log.info('[%s] Circuit half-open, sending a probe.', self._name)
+                self._state = self.HALF_OPEN
+                return True
+            return False
+
+    def retry_in(self):
+        '''Seconds until the breaker will let a probe through.'''
+        with self._lock:
+            if self._state == self.CLOSED:
+                return 0
+            # A probe is already out, check back once it's had time to finish
+            return max(1.0, self._reset - (time.time() - self._opened))
+
+    def success(self):
+        with self._lock:
+            if self._state != self.CLOSED:
+                log.info('[%s] Circuit closed, service is back.', self._name)
+            self._state = self.CLOSED
+            self._failures = 0
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or (
+                    self._state == self.CLOSED and self._failures >= self._threshold):
+                self._open()
+
+    def inconclusive(self):
+        '''An outcome that says nothing about the service, like a permanent
+        error. It doesn't count towards opening the breaker, but a probe has
+        to end one way or the other, so one ending like this counts as failed
+        and another follows after the reset period.'''
+        with self._lock:
+            if self._state == self.HALF_OPEN:
+                self._open()
+
+    def _open(self):
+        log.warning('[%s] Circuit open after %i failure(s), pausing uploads for %gs.',
+            self._name, self._failures, self._reset)
+        self._state = self.OPEN
+        self._opened = time.time()
+
+    @property
+    def state(self):
+        return self._state
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(config, service):
+    '''Return the shared CircuitBreaker for service.'''
+    with _breakers_lock:
+        if service not in _breakers:
+            settings = Settings(config)
+            _breakers[service] = CircuitBreaker(service, settings.threshold, settings.reset)
+        return _breakers[service]
+
+
+class Scheduler(object):
+    '''Runs callbacks after a delay on one background thread.'''
+    _heap = None
+    _cond = None
+    _counter = None
+
+    def __init__(self):
+        super(Scheduler, self).__init__()
+        self._heap = []
+        self._cond = threading.Condition()
+        self._counter = itertools.count()
+        newthread = threading.Thread(target=self._run, name='scheduler')
+        newthread.daemon = True
+        newthread.start()
+
+    def later(self, delay, callback, *args):
+        with self._cond:
+            heapq.heappush(self._heap, (time.time() + delay, next(self._counter), callback, args))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                _, _, callback, args = heapq.heappop(self._heap)
+            try:
+                callback(*args)
+            except Exception:
+                log.exception('Scheduled callback failed')
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def later(delay, callback, *args):
+    '''Call callback(*args) from the scheduler thread in delay seconds.'''
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler()
+    _scheduler.later(delay, callback, *args)
@@ -2,14 +2,23 @@
 imgur.py
 imgur.com specific uploader
 '''
-from sqlite3 import IntegrityError
+from base64 import b64encode
 
 import pyimgur
+import requests
 
 import mercury.log
+import mercury.resilience
+import mercury.tokens
 
 log = mercury.log.getLogger()
 
+# Image formats, by Pillow name, the service takes as is
+formats = ('JPEG', 'PNG', 'GIF')
+
+# The wrapper doesn't pass on expires_in, so assume imgur's documented hour.
+_token_ttl = 3600
+
 
 def authenticate(config):
     log.debug('[imgur] Starting authentication setup.')
@@ -22,31 +31,9 @@ def authenticate(config):
         config['imgur'] = {}
 
     if 'api_object' not in config['imgur']:
-        con = config['db'].connect()
-        cur = con.cursor()
-        try:
-            try:
-                log.debug('[imgur] Inserting service name into services')
-                with con:
-                    con.execute("insert into services (service_name) values ('imgur')")
-            except IntegrityError:
-                log.debug('[imgur] Found service name in services')
-                pass
-            cur.execute(
-                """
-                select token_value
-                from service_auth
-                where token_name = 'refresh_token'
-                and service_id = (
-                    select service_id
-                    from services
-                    where service_name = 'imgur') """)
-            auth_token = cur.fetchone()
-        finally:
-            cur.close()
-            con.close()
+        auth_token = config['db'].get_token('imgur', 'refresh_token')
         if auth_token:
-            log.debug('[imgur] Found stored refresh_token: %s' % auth_token)
+            log.debug('[imgur] Found stored refresh_token: %s', auth_token)
             # Setup the Imgur object with a previous refresh token
             api_wrapper = pyimgur.Imgur(
                 client_id=config['services']['imgur']['client_id'],
@@ -63,65 +50,77 @@ def authenticate(config):
                 client_secret=config['services']['imgur']['client_secret'])
             url = api_wrapper.authorization_url('pin')
             pin = raw_input("Visit %s to authenticate the application. Enter the pin here: " % url)
-            log.debug('[imgur] Got pin %s' % pin)
+            log.debug('[imgur] Got pin %s', pin)
             # TODO handle bad pins
             _, refresh_token = api_wrapper.exchange_pin(pin)
-            log.debug('[imgur] Got refresh token: %s' % refresh_token)
+            log.debug('[imgur] Got refresh token: %s', refresh_token)
 
             # save refresh_token in database
-            try:
-                con = config['db'].connect()
-                with con:
-                    con.execute(
-                        """
-                        insert into services (service_name)
-                            values ('imgur') """)
-                with con:
-                    con.execute(
-                        """
-                        insert into service_auth (service_id, token_name, token_value)
-                        values (
-                            (select service_id from services where service_name = 'imgur'),
-                            'refresh_token',
-                            ?) """, (refresh_token,))
-            finally:
-                con.close()
+            config['db'].set_token('imgur', 'refresh_token', refresh_token)
         config['imgur']['api_object'] = api_wrapper
+        config['imgur']['tokens'] = mercury.tokens.TokenManager('imgur', lambda: _refresh(config))
+        config['imgur']['tokens'].set(api_wrapper.access_token, _token_ttl)
     return config
 
 
-def upload(config, path, title=None, description=None, *args, **kwargs):
-    log.debug('[imgur] Upload called.')
+def _refresh(config):
     api = config['imgur']['api_object']
 
-    # First things first, let's work around a limitation in the api wrapper. it
-    # doesn't refresh tokens correctly it seems, and the refresh token is now
-    # sent back as a new refresh_token on each refresh. This new refresh_token
-    # needs to be stored in our database and refreshed each time we want to
-    # upload an image. This could be overkill if we're uploading images more
-    # than once an hour so a time limiter would be nice.
+    # Work around a limitation in the api wrapper: the refresh token can be
+    # sent back as a new refresh_token on a refresh, and that one needs to be
+    # stored in our database for the next run. Only called by the token
+    # manager once the current access token is close to expiring.
+    previous = api.refresh_token
     api.refresh_access_token()
-    # save refresh_token in database
+    if api.refresh_token != previous:
+        # save refresh_token in database
+        config['db'].set_token('imgur', 'refresh_token', api.refresh_token)
+    return api.access_token, _token_ttl
+
+
+def _api(config):
+    # Makes sure the wrapper holds an access token that isn't about to expire
+    config['imgur']['tokens'].get()
+    return config['imgur']['api_object']
+
+
+def _rejected(config, api, e):
+    # Drop a refused access token so the retry refreshes it
+    if e.response is not None and e.response.status_code in (401, 403):
+        config['imgur']['tokens'].invalidate(api.access_token)
+
+
+def upload(config, path, title=None, description=None, *args, **kwargs):
+    log.debug('[imgur] Upload called.')
+    return _upload(config, path)
+
+
+def upload_bytes(config, buf, format, title=None, description=None, *args, **kwargs):
+    log.debug('[imgur] Upload from memory called.')
+    # imgur's image field takes either a url or base64 image data, so the
+    # wrapper's url argument lets us post without a file on disk.
+    return _upload(config, url=b64encode(buf.read()))
+
+
+def _upload(config, path=None, url=None):
+    api = _api(config)
     try:
-        con = config['db'].connect()
-        with con:
-            con.execute(
-                """
-                update service_auth
-                set token_value = ?
-                where token_name = 'refresh_token'
-                and service_id = (
-                    select service_id
-                    from services
-                    where service_name = 'imgur') """, (api.refresh_token,))
-    finally:
-        con.close()
-    # That housekeeping aside, we can move on to our uploading.
-
-    # TODO Handle errors
-    results = api.upload_image(path)
+        results = api.upload_image(path, url=url)
+    except requests.HTTPError as e:
+        _rejected(config, api, e)
+        raise
+    except (ValueError, KeyError) as e:
+        # The wrapper reads the body as JSON before checking the status, so
+        # an outage's HTML error page comes out as a ValueError, or a
+        # KeyError when the JSON isn't imgur's
+        log.debug('[imgur] Unreadable response', exc_info=True)
+        raise mercury.resilience.TransientError('imgur sent back a response that isn\'t its JSON: %s' % e)
+    return _log_results(results)
+
+
+def _log_results(results):
     if results:
         log.info('[imgur] image uploaded.')
-        log.info('[imgur] link: %s' % results.link)
-        log.info('[imgur] delete hash: %s' % results.deletehash)
+        log.info('[imgur] link: %s', results.link)
+        log.info('[imgur] delete hash: %s', results.deletehash)
     return results
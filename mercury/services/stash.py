@@ -5,18 +5,26 @@ sta.sh specific uploader
 from __future__ import print_function
 
 import json
+import os.path
 import urllib
 import urlparse
-from sqlite3 import IntegrityError
-
-import httplib2
-import requests
 
 import mercury.log
+import mercury.multipart
+import mercury.resilience
+import mercury.sessions
+import mercury.tokens
 
 log = mercury.log.getLogger()
 redirect_url = 'http://localhost/oauth2'
 
+# Lifetime assumed for a token that passed the placebo check but whose actual
+# expiry we don't know. A rejected upload invalidates it early anyway.
+_unknown_ttl = 300
+
+# Image formats, by Pillow name, the service takes as is
+formats = ('JPEG', 'PNG', 'GIF')
+
 
 def authenticate(config):
     log.debug('Starting authentication setup.')
@@ -26,22 +34,12 @@ def authenticate(config):
 
     config['stash'] = {}
 
-    con = config['db'].connect()
-    try:
-        log.debug('Inserting service name into services')
-        with con:
-            con.execute("insert into services (service_name) values ('stash')")
-    except IntegrityError:
-        log.debug('Found service name in services')
-        pass
-    finally:
-        con.close()
-
     stored_tokens = load_from_db(config)
+    expires_in = _unknown_ttl
     if stored_tokens:
-        access_token = stored_tokens['access_token'][0]
-        refresh_token = stored_tokens['refresh_token'][0]
-        log.debug('Found stored auth: \n  access_token: %s \n  refresh_token: %s' % (access_token, refresh_token))
+        access_token = stored_tokens['access_token']
+        refresh_token = stored_tokens['refresh_token']
+        log.debug('Found stored auth: \n  access_token: %s \n  refresh_token: %s', access_token, refresh_token)
         try:
             refreshed_tokens = refresh_tokens(config, access_token, refresh_token)
         except UserWarning:
@@ -51,6 +49,7 @@ def authenticate(config):
         if refreshed_tokens:
             access_token = refreshed_tokens['access_token']
             refresh_token = refreshed_tokens['refresh_token']
+            expires_in = refreshed_tokens['expires_in']
     else:
         parameters = urllib.urlencode({'client_id': client_id, 'response_type': 'code', 'redirect_uri': redirect_url})
         print('Visit the following url and authorize. Paste the resultant redirected URL here:')
@@ -62,7 +61,8 @@ def authenticate(config):
 
         #We now have a code that can be used to request a token
         parameters = urllib.urlencode({'client_id': client_id, 'client_secret': client_secret, 'grant_type': 'authorization_code', 'code': code, 'redirect_uri': redirect_url})
-        resp, content = httplib2.Http(disable_ssl_certificate_validation=True).request('https://www.deviantart.com/oauth2/token?%s' % parameters)
+        resp = _session(config).get('https://www.deviantart.com/oauth2/token?%s' % parameters)
+        content = resp.text
         try:
             content = json.loads(content)
         except ValueError:
@@ -71,40 +71,24 @@ def authenticate(config):
             log.error(content)
             return
         access_token = content['access_token']
-        log.debug('New access token: %s' % access_token)
+        log.debug('New access token: %s', access_token)
         refresh_token = content['refresh_token']
-        log.debug('New refresh token: %s' % refresh_token)
+        log.debug('New refresh token: %s', refresh_token)
+        expires_in = content.get('expires_in', _unknown_ttl)
     config = update_db(config, access_token, refresh_token)
+    config['stash']['tokens'] = mercury.tokens.TokenManager('sta.sh', lambda: _renew(config))
+    config['stash']['tokens'].set(access_token, expires_in)
     return config
 
 
+def _session(config):
+    # Token calls and uploads share one keep-alive pool
+    return mercury.sessions.session(config, 'sta.sh')
+
+
 def load_from_db(config):
-    con = config['db'].connect()
-    cur = con.cursor()
-    try:
-        cur.execute(
-            """
-            select token_value
-            from service_auth
-            where token_name = 'access_token'
-            and service_id = (
-                select service_id
-                from services
-                where service_name = 'stash') """)
-        access_token = cur.fetchone()
-        cur.execute(
-            """
-            select token_value
-            from service_auth
-            where token_name = 'refresh_token'
-            and service_id = (
-                select service_id
-                from services
-                where service_name = 'stash') """)
-        refresh_token = cur.fetchone()
-    finally:
-        cur.close()
-        con.close()
+    access_token = config['db'].get_token('stash', 'access_token')
+    refresh_token = config['db'].get_token('stash', 'refresh_token')
     if access_token and refresh_token:
         return {'access_token': access_token, 'refresh_token': refresh_token}
     else:
@@ -112,36 +96,8 @@ def load_from_db(config):
 
 
 def update_db(config, access_token, refresh_token):
-    try:
-        con = config['db'].connect()
-        with con:
-            con.execute(
-                """
-                delete from service_auth
-                where service_id = (
-                    select service_id
-                    from services
-                    where service_name = 'stash') """)
-        with con:
-            con.execute(
-                """
-                insert into service_auth (token_name, token_value, service_id)
-                values(
-                    'access_token',
-                    ?,
-                    (select service_id from services where service_name = 'stash')
-                ) """, (access_token,))
-        with con:
-            con.execute(
-                """
-                insert into service_auth (token_name, token_value, service_id)
-                values(
-                    'refresh_token',
-                    ?,
-                    (select service_id from services where service_name = 'stash')
-                ) """, (refresh_token,))
-    finally:
-        con.close()
+    config['db'].set_token('stash', 'access_token', access_token)
+    config['db'].set_token('stash', 'refresh_token', refresh_token)
     config['stash']['access_token'] = access_token
     config['stash']['refresh_token'] = refresh_token
     return config
@@ -150,60 +106,87 @@ def update_db(config, access_token, refresh_token):
 def refresh_tokens(config, access_token, refresh_token):
     # First hit the placebo api endpoint to see if the access token is still
     # good.
-    client_id = config['services']['sta.sh']['client_id']
-    client_secret = config['services']['sta.sh']['client_secret']
     parameters = urllib.urlencode({'access_token': access_token})
-    resp, content = httplib2.Http(disable_ssl_certificate_validation=True).request('https://www.deviantart.com/api/oauth2/placebo?%s' % parameters)
-    if resp['status'] != '200':
+    resp = _session(config).get('https://www.deviantart.com/api/oauth2/placebo?%s' % parameters)
+    if resp.status_code != 200:
         # If the token is not good anymore, refresh the token
-        parameters = urllib.urlencode({'client_id': client_id, 'client_secret': client_secret, 'grant_type': 'refresh_token', 'refresh_token': refresh_token, 'redirect_uri': redirect_url})
-        resp, content = httplib2.Http(disable_ssl_certificate_validation=True).request('https://www.deviantart.com/oauth2/token?%s' % parameters)
-        if resp['status'] == '200':
-            try:
-                content = json.loads(content)
-            except ValueError:
-                log.error('Received bad JSON on token refresh.')
-                log.error(resp)
-                log.error(content)
-                raise UserWarning
-            access_token = content['access_token']
-            log.debug('New access token: %s' % access_token)
-            refresh_token = content['refresh_token']
-            log.debug('New refresh token: %s' % refresh_token)
-            return {'access_token': access_token, 'refresh_token': refresh_token}
-        else:
-            log.error('Bad response when trying to refresh tokens.')
+        return _grant(config, refresh_token)
+    else:
+        log.debug('Current access token is still good.')
+        return {}
+
+
+def _grant(config, refresh_token):
+    client_id = config['services']['sta.sh']['client_id']
+    client_secret = config['services']['sta.sh']['client_secret']
+    parameters = urllib.urlencode({'client_id': client_id, 'client_secret': client_secret, 'grant_type': 'refresh_token', 'refresh_token': refresh_token, 'redirect_uri': redirect_url})
+    resp = _session(config).get('https://www.deviantart.com/oauth2/token?%s' % parameters)
+    content = resp.text
+    if resp.status_code == 200:
+        try:
+            content = json.loads(content)
+        except ValueError:
+            log.error('Received bad JSON on token refresh.')
             log.error(resp)
             log.error(content)
             raise UserWarning
+        access_token = content['access_token']
+        log.debug('New access token: %s', access_token)
+        refresh_token = content['refresh_token']
+        log.debug('New refresh token: %s', refresh_token)
+        return {'access_token': access_token, 'refresh_token': refresh_token,
+                'expires_in': content.get('expires_in', _unknown_ttl)}
     else:
-        log.debug('Current access token is still good.')
-        return {}
+        log.error('Bad response when trying to refresh tokens.')
+        log.error(resp)
+        log.error(content)
+        raise UserWarning
+
+
+def _renew(config):
+    # Called by the token manager when the access token is expiring or was
+    # rejected. No need to ask placebo first, we already know it's no good.
+    refreshed_tokens = _grant(config, config['stash']['refresh_token'])
+    update_db(config, refreshed_tokens['access_token'], refreshed_tokens['refresh_token'])
+    return refreshed_tokens['access_token'], refreshed_tokens['expires_in']
 
 
 def upload(config, path, title=None, description=None, tags=None, *args, **kwargs):
     log.debug('Upload called.')
-    stored_tokens = load_from_db(config)
-    access_token = stored_tokens['access_token'][0]
-    refresh_token = stored_tokens['refresh_token'][0]
-    submit_url = 'https://www.deviantart.com/api/oauth2/stash/submit?%s'
+    with open(path, 'rb') as f:
+        return _submit(config, os.path.basename(path), f, title, description, tags)
+
 
+def upload_bytes(config, buf, format, title=None, description=None, tags=None, *args, **kwargs):
+    log.debug('Upload from memory called.')
+    return _submit(config, 'mercury.%s' % format.lower(), buf, title, description, tags)
+
+
+def _submit(config, filename, f, title, description, tags):
+    log.debug('Posting image to sta.sh')
+    for attempt in range(2):
+        url, headers, body, access_token = request(config, filename, f, title, description, tags)
+        resp = _session(config).post(url, data=body, headers=headers)
+        log.debug('Finished upload.')
+        if resp.status_code == 401 and not attempt:
+            # Token was revoked or expired early, get a new one and retry
+            config['stash']['tokens'].invalidate(access_token)
+            continue
+        return response(config, resp, access_token)
+
+
+def request(config, filename, f, title=None, description=None, tags=None):
+    '''
+    Return (url, headers, body, access_token) for posting f to sta.sh, for
+    callers that make the request themselves. Pass what comes back, along
+    with access_token, to response(). Blocks if the token needs refreshing.
+    '''
+    tokens = config['stash']['tokens']
+    submit_url = 'https://www.deviantart.com/api/oauth2/stash/submit?%s'
     try:
-        refreshed_tokens = refresh_tokens(config, access_token, refresh_token)
+        access_token = tokens.get()
     except UserWarning:
-        log.error('Unable to refresh tokens, sta.sh may be unavailable ' +
-                  'or another thread may have already fetched new tokens. ' +
-                  'Pulling new tokens from DB and attempting upload anyway.')
-        refreshed_tokens = None
-        stored_tokens = load_from_db(config)
-        access_token = stored_tokens['access_token'][0]
-        refresh_token = stored_tokens['refresh_token'][0]
-
-    if refreshed_tokens:
-        access_token = refreshed_tokens['access_token']
-        refresh_token = refreshed_tokens['refresh_token']
-
-        config = update_db(config, access_token, refresh_token)
+        raise mercury.resilience.AuthError('Unable to refresh sta.sh tokens')
     parameters = {'access_token': access_token}
     if title:
         parameters['title'] = title
@@ -211,24 +194,24 @@ def upload(config, path, title=None, description=None, tags=None, *args, **kwarg
         parameters['artist_comments'] = description
     if tags:
         parameters['keywords'] = tags
-    parameters = urllib.urlencode(parameters)
-    log.debug('Posting image to sta.sh')
-    for attempt in range(2):
-        resp = requests.post(
-            submit_url % parameters,
-            files={'file': open(path, 'rb')})
-        log.debug('Finished upload.')
-        if resp.status_code == 200:
-            #exit for loop on successful upload
-            break
-        # May have failed due to another thread updating the tokens.
-        stored_tokens = load_from_db(config)
-        access_token = stored_tokens['access_token'][0]
-        refresh_token = stored_tokens['refresh_token'][0]
-    if resp.status_code != 200:
-        #File did not upload correctly
-        log.error('Error uploading file')
-        log.error('status code %s' % resp.status_code)
-        log.error(resp.text)
-        return
-    return resp
+    # Streamed from f a chunk at a time, never held in memory whole.
+    # sta.sh has no resumable uploads, so a retry sends it from the start.
+    f.seek(0)
+    body = mercury.multipart.MultipartStream('file', filename, f)
+    return (submit_url % urllib.urlencode(parameters),
+            {'Content-Type': body.content_type}, body, access_token)
+
+
+def response(config, resp, access_token):
+    '''Return resp if it's a successful upload, or raise the matching
+    UploadError.'''
+    if resp.status_code == 200:
+        return resp
+    if resp.status_code == 401:
+        config['stash']['tokens'].invalidate(access_token)
+    #File did not upload correctly
+    log.error('Error uploading file')
+    log.error('status code %s', resp.status_code)
+    log.error(resp.text)
+    raise mercury.resilience.error_for_status(
+        resp.status_code, 'sta.sh returned %s' % resp.status_code)
@@ -0,0 +1,73 @@
+'''
+sessions.py
+Long lived HTTP sessions, one per service, so uploads and token calls reuse
+kept-alive connections instead of paying for a new TCP and TLS handshake on
+every request. Requests made through them time out after http_timeout
+seconds (60 by default) without hearing from the host, so a stalled host
+fails like any other outage instead of holding a worker forever.
+'''
+import threading
+
+import requests
+import requests.adapters
+
+import mercury.log
+
+log = mercury.log.getLogger()
+
+_sessions = {}
+_lock = threading.Lock()
+
+
+class _TimeoutAdapter(requests.adapters.HTTPAdapter):
+    '''An HTTPAdapter applying a timeout to requests made without one.'''
+    _timeout = None
+
+    def __init__(self, timeout, **kwargs):
+        self._timeout = timeout
+        super(_TimeoutAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self._timeout
+        return super(_TimeoutAdapter, self).send(request, **kwargs)
+
+
+def session(config, service):
+    '''
+    Return the shared requests.Session for service, the config name as listed
+    under services. Its pool holds a connection per upload worker plus one
+    for token calls made alongside them.
+    '''
+    with _lock:
+        if service not in _sessions:
+            size = _concurrency(config, service) + 1
+            log.debug('Creating %s session with a pool of %i connection(s).', service, size)
+            adapter = _TimeoutAdapter(timeout(config), pool_connections=1, pool_maxsize=size)
+            s = requests.Session()
+            s.mount('https://', adapter)
+            s.mount('http://', adapter)
+            _sessions[service] = s
+        return _sessions[service]
+
+
+def _concurrency(config, service):
+    if 'services' in config and service in config['services'] and config['services'][service]:
+        if 'concurrency' in config['services'][service] and config['services'][service]['concurrency']:
+            return int(config['services'][service]['concurrency'])
+    return 1
+
+
+def timeout(config):
+    '''Seconds an HTTP request may go without progress, http_timeout.'''
+    if 'http_timeout' in config and config['http_timeout']:
+        return float(config['http_timeout'])
+    return 60.0
+
+
+def close():
+    '''Close every session's pooled connections.'''
+    with _lock:
+        for s in _sessions.values():
+            s.close()
+        _sessions.clear()
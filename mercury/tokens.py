@@ -0,0 +1,77 @@
+'''
+tokens.py
+In-process cache for service access tokens.
+'''
+import threading
+import time
+
+import mercury.log
+
+log = mercury.log.getLogger()
+
+
+class TokenManager(object):
+    '''
+    Holds a service's access token along with when it expires and only calls
+    refresh when it is within margin seconds of expiring. Callers that need a
+    token while a refresh is already running wait for that one rather than
+    starting their own, so a burst of uploads costs a single refresh.
+
+    refresh is called with no arguments and returns (token, expires_in).
+    '''
+    _name = None
+    _refresh = None
+    _margin = None
+    _token = None
+    _expires = 0
+    _refreshing = False
+    _cond = None
+
+    def __init__(self, name, refresh, margin=60):
+        super(TokenManager, self).__init__()
+        self._name = name
+        self._refresh = refresh
+        self._margin = margin
+        self._cond = threading.Condition()
+
+    def get(self):
+        '''Return a token good for at least margin more seconds.'''
+        with self._cond:
+            while self._refreshing:
+                self._cond.wait()
+            if self._token and time.time() < self._expires - self._margin:
+                return self._token
+            self._refreshing = True
+
+        log.debug('[%s] Refreshing access token.', self._name)
+        try:
+            token, expires_in = self._refresh()
+        except:
+            with self._cond:
+                self._refreshing = False
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._token = token
+            self._expires = time.time() + expires_in
+            self._refreshing = False
+            self._cond.notify_all()
+        log.debug('[%s] New access token good for %is.', self._name, expires_in)
+        return token
+
+    def set(self, token, expires_in):
+        '''Seed the cache with a token obtained elsewhere.'''
+        with self._cond:
+            self._token = token
+            self._expires = time.time() + expires_in
+
+    def invalidate(self, token):
+        '''
+        Drop token after a service rejected it, so the next get() refreshes.
+        Ignored if the token has already been replaced, which keeps a batch of
+        uploads that failed together from refreshing once each.
+        '''
+        with self._cond:
+            if token == self._token:
+                self._token = None
+                self._expires = 0
@@ -2,6 +2,8 @@
 watcher.py
 Module to set up directory watching for file creation events.
 '''
+import os.path
+import threading
 import time
 
 from watchdog.observers import Observer
@@ -9,25 +11,155 @@ from watchdog.events import FileSystemEventHandler
 
 import mercury.log
 import mercury.dispatcher
+import mercury.metrics
+import mercury.priority
 
 log = mercury.log.getLogger()
 
 
+class Stabilizer(object):
+    '''
+    Holds files that may still be being written and hands each to callback
+    once its size and mtime have held still for quiet_period seconds. When
+    the OS reports a file closed the wait is cut to close_grace seconds
+    instead, long enough for a tool that writes a temporary file and renames
+    it into place to do so, which drops the temporary name. Any number of
+    files can wait at once.
+    '''
+    _pending = None
+    _lock = None
+    _quiet = None
+    _grace = None
+    _interval = None
+    _callback = None
+    _stop = None
+    _thread = None
+
+    def __init__(self, config, callback):
+        super(Stabilizer, self).__init__()
+        self._quiet = 2.0
+        if 'quiet_period' in config and config['quiet_period'] is not None:
+            self._quiet = float(config['quiet_period'])
+        self._grace = min(0.5, self._quiet)
+        if 'close_grace' in config and config['close_grace'] is not None:
+            self._grace = float(config['close_grace'])
+        self._interval = max(0.05, min(1.0, self._quiet / 4, self._grace / 2))
+        self._callback = callback
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+        newthread = self._thread = threading.Thread(target=self._worker)
+        newthread.daemon = True
+        newthread.start()
+        log.debug('Stabilizer %s started with a %ss quiet period.', newthread.name, self._quiet)
+
+    def track(self, path):
+        '''Start, or restart, waiting on path.'''
+        now = time.time()
+        with self._lock:
+            first = self._pending[path][2] if path in self._pending else now
+            self._pending[path] = (None, now, first, None)
+
+    def closed(self, path):
+        '''path was closed after writing: hand it on after the grace period
+        unless it's renamed, removed or written to again meanwhile.'''
+        now = time.time()
+        with self._lock:
+            last, since, first, closed = self._pending.get(path, (None, now, now, None))
+            self._pending[path] = (last, since, first, now)
+
+    def forget(self, path):
+        with self._lock:
+            self._pending.pop(path, None)
+
+    def ready(self, path):
+        '''path is known to be complete, skip the rest of the wait.'''
+        with self._lock:
+            entry = self._pending.pop(path, None)
+        if entry:
+            self._settled(entry[2])
+        self._callback(path)
+
+    def _settled(self, first):
+        mercury.metrics.observe('mercury_stage_seconds', time.time() - first, stage='stabilize')
+
+    def stop(self):
+        '''Stop watching, dropping whatever is still waiting.'''
+        self._stop.set()
+        self._thread.join()
+
+    def _worker(self):
+        while not self._stop.wait(self._interval):
+            now = time.time()
+            done = []
+            with self._lock:
+                for path, (last, since, first, closed) in self._pending.items():
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        log.debug('%s went away before it settled.', path)
+                        del self._pending[path]
+                        continue
+                    current = (stat.st_size, stat.st_mtime)
+                    if closed and stat.st_mtime > closed:
+                        # Opened and written again since it was closed
+                        closed = None
+                    if current != last:
+                        self._pending[path] = (current, now, first, closed)
+                    if (closed and now - closed >= self._grace) or \
+                            (current == last and now - since >= self._quiet):
+                        del self._pending[path]
+                        done.append((path, first))
+            for path, first in done:
+                log.debug('%s has settled.', path)
+                self._settled(first)
+                self._callback(path)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+
 class customHandler(FileSystemEventHandler):
     _config = None
+    _stabilizer = None
+
+    def _ignored(self, event, path):
+        # Our own database and its journals live here by default
+        if path.endswith(('.sqlite', 'sqlite-journal', 'sqlite-wal', 'sqlite-shm')):
+            return True
+        if event.is_directory:
+            log.debug('Event was a directory. Ignoring.')
+            return True
+        return False
 
     def on_created(self, event):
-        if event.src_path.endswith('sqlite-journal'):
+        if self._ignored(event, event.src_path):
             return
         log.debug('CustomHandler triggered')
-        if event.is_directory:
-            log.debug('Event was a directory. Ignoring.')
+        log.debug('Waiting for the file at %s to be complete', event.src_path)
+        self._stabilizer.track(event.src_path)
+
+    def on_moved(self, event):
+        # Files renamed into place once fully written, as many tools do
+        self._stabilizer.forget(event.src_path)
+        if self._ignored(event, event.dest_path):
+            return
+        if os.path.dirname(os.path.abspath(event.dest_path)) not in watched(self._config):
+            return
+        log.debug('File moved into place at %s', event.dest_path)
+        self._stabilizer.ready(event.dest_path)
+
+    def on_closed(self, event):
+        # Only delivered by observers that support it (inotify IN_CLOSE_WRITE)
+        if self._ignored(event, event.src_path):
             return
-        #time.sleep(60)  # Wait a bit to make sure the file's been written
-        time.sleep(10)
-        #TODO file may be gone, handle quietly
-        log.debug('Time to work with the file at %s' % event.src_path)
-        mercury.dispatcher.dispatch(self._config, event.src_path)
+        log.debug('File closed after writing at %s', event.src_path)
+        self._stabilizer.closed(event.src_path)
+
+    def on_deleted(self, event):
+        self._stabilizer.forget(event.src_path)
 
     @property
     def config(self):
@@ -38,17 +170,43 @@ class customHandler(FileSystemEventHandler):
     def config(self, value):
         self._config = value
 
+    @property
+    def stabilizer(self):
+        return self._stabilizer
+
+    @stabilizer.setter
+    def stabilizer(self, value):
+        self._stabilizer = value
+
+
+def watched(config):
+    '''Every folder files are picked up from: the watched folder and any
+    priority_folders.'''
+    folders = [os.path.abspath(config['watched_folder'])]
+    for folder in mercury.priority.folders(config):
+        if folder not in folders:
+            folders.append(folder)
+    return folders
+
 
 def startWatcher(config, path, interval):
     event_handler = customHandler()
     event_handler.config = config
+    event_handler.stabilizer = Stabilizer(config, mercury.dispatcher.dispatchworkers.put)
     observer = Observer()
     observer.schedule(event_handler, path, recursive=False)
+    for folder in watched(config)[1:]:
+        if not os.path.isdir(folder):
+            log.warning('Priority folder %s does not exist, not watching it.', folder)
+            continue
+        log.info('Watching %s at priority %g', folder, mercury.priority.folders(config)[folder])
+        observer.schedule(event_handler, folder, recursive=False)
     observer.start()
     try:
         while True:
             time.sleep(interval)
     except:
         observer.stop()
+        event_handler.stabilizer.stop()
         raise
     observer.join()
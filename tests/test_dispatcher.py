@@ -0,0 +1,261 @@
+'''
+test_dispatcher.py
+Dispatch and resize behaviour with files that fail part way through.
+
+    python -m unittest discover tests
+'''
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image
+
+import mercury.database
+import mercury.dispatcher
+import mercury.services
+
+
+class BudgetTest(unittest.TestCase):
+    def test_over_release_is_logged(self):
+        errors = []
+        mercury.dispatcher.log.error = lambda *args: errors.append(args)
+        self.addCleanup(delattr, mercury.dispatcher.log, 'error')
+
+        budget = mercury.dispatcher.Budget()
+        budget.charge(10)
+        budget.release(4)
+        self.assertEqual(errors, [])
+        budget.release(10)
+        self.assertEqual(budget.used, 0)
+        self.assertEqual(len(errors), 1)
+
+
+class ResizePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+    def _jpeg(self, name, truncate=False):
+        buf = io.BytesIO()
+        Image.new('RGB', (400, 300), (200, 30, 30)).save(buf, 'JPEG')
+        data = buf.getvalue()
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data[:len(data) // 2] if truncate else data)
+        return path
+
+    def _job(self, path):
+        return {'file': path, 'format': 'JPEG', 'cost': 0, 'services': ['pool-test'],
+                'hash': None, 'phash': None, 'priority': 0}
+
+    def test_bad_file_doesnt_stop_the_pool(self):
+        config = {'services': {'pool-test': None},
+                  'database_file': os.path.join(self.root, 'test.sqlite')}
+        config['db'] = mercury.database.db(config)
+        journal = config['journal'] = mercury.database.Journal(config['db'])
+
+        pool = mercury.dispatcher.ResizePool(config, 1)
+        worker = mercury.dispatcher.ResizeWorker(config, pool, (100, 100), ['pool-test'])
+        pool.start()
+
+        bad, good = self._jpeg('bad.jpg', truncate=True), self._jpeg('good.jpg')
+        for path in (bad, good):
+            journal.add(self._job(path), ['pool-test'])
+            mercury.dispatcher.pending.add()
+            worker.put(self._job(path))
+
+        data, format, service, job = mercury.dispatcher._upload.get(timeout=30)
+        self.assertEqual(job['file'], good)
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (100, 75))
+        mercury.dispatcher.pending.done()
+
+        # The bad file isn't left to be resized again on the next start
+        stages = dict(config['db'].connect().execute('select file, stage from jobs').fetchall())
+        self.assertEqual(stages[bad], 'failed')
+
+
+class DispatchWorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+
+    def _patch(self, name, value):
+        original = getattr(mercury.dispatcher, name)
+        setattr(mercury.dispatcher, name, value)
+        self.addCleanup(setattr, mercury.dispatcher, name, original)
+
+    def test_unexpected_error_doesnt_end_the_thread(self):
+        done = []
+
+        def dispatch(config, path, archive=True):
+            if path == 'bad':
+                raise RuntimeError('decoder blew up')
+            done.append(path)
+        self._patch('dispatch', dispatch)
+
+        workers = mercury.dispatcher.DispatchWorkers({}, 1)
+        workers.put('bad')
+        workers.put('good')
+        workers.join()
+        self.assertEqual(done, ['good'])
+
+    def test_failed_dispatch_gives_back_its_budget(self):
+        def move(src, dst):
+            raise RuntimeError('archive went away')
+        original = shutil.move
+        shutil.move = move
+        self.addCleanup(setattr, shutil, 'move', original)
+
+        class Worker(object):
+            services = ['dispatch-test']
+        self._patch('resizeworkers', [Worker()])
+        mercury.services.registry['dispatch-test'] = object()
+        self.addCleanup(mercury.services.registry.pop, 'dispatch-test')
+
+        path = os.path.join(self.root, 'a.png')
+        Image.new('RGB', (50, 40)).save(path)
+        config = {'services': {'dispatch-test': None}, 'dedup': False,
+                  'watched_folder': self.root, 'archive_folder': self.root}
+        before = mercury.dispatcher.budget.used
+        self.assertRaises(RuntimeError, mercury.dispatcher.dispatch, config, path)
+        self.assertEqual(mercury.dispatcher.budget.used, before)
+
+
+class ArchiveJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.archive = os.path.join(self.root, 'archive')
+        os.mkdir(self.archive)
+        self.config = {'services': {'journal-test': None}, 'dedup': False,
+                       'watched_folder': self.root, 'archive_folder': self.archive,
+                       'database_file': os.path.join(self.root, 'test.sqlite')}
+        self.config['db'] = mercury.database.db(self.config)
+        self.journal = self.config['journal'] = mercury.database.Journal(self.config['db'])
+        mercury.services.registry['journal-test'] = object()
+        self.addCleanup(mercury.services.registry.pop, 'journal-test')
+
+    def _rows(self):
+        return self.config['db'].connect().execute('select file, stage from jobs').fetchall()
+
+    def test_job_is_journaled_before_the_move(self):
+        path = os.path.join(self.root, 'a.png')
+        Image.new('RGB', (50, 40)).save(path)
+        seen = []
+
+        def move(src, dst):
+            seen.extend(self._rows())
+            raise IOError('disk full')
+        original = shutil.move
+        shutil.move = move
+        self.addCleanup(setattr, shutil, 'move', original)
+
+        self.assertRaises(IOError, mercury.dispatcher.dispatch, self.config, path)
+        archived = os.path.join(self.archive, 'a.png')
+        self.assertEqual(seen, [(archived, 'resize')])
+        # Nothing is left behind for a file that's still in the watched folder
+        self.assertEqual(self._rows(), [])
+        self.assertFalse(os.path.exists(archived))
+        self.assertTrue(os.path.exists(path))
+
+    def test_in_place_dispatch_leaves_the_file(self):
+        folder = os.path.join(self.root, 'old', '2019')
+        os.makedirs(folder)
+        path = os.path.join(folder, 'a.png')
+        Image.new('RGB', (50, 40)).save(path)
+        mercury.dispatcher.dispatch(self.config, path, archive=False)
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(os.listdir(self.archive), [])
+        self.assertEqual(self._rows(), [(path, 'resize')])
+
+    def test_replay_dispatches_files_that_never_moved_again(self):
+        mercury.dispatcher.uploadqueues['journal-test'] = None
+        self.addCleanup(mercury.dispatcher.uploadqueues.pop, 'journal-test')
+        queued = []
+
+        class Workers(object):
+            def put(self, path, archive=True):
+                queued.append(path)
+        original = mercury.dispatcher.dispatchworkers
+        mercury.dispatcher.dispatchworkers = Workers()
+        self.addCleanup(setattr, mercury.dispatcher, 'dispatchworkers', original)
+
+        # One stopped before the move started, one part way through copying
+        for name, partial in (('a.png', ''), ('b.png', '\x89PNG\r\n')):
+            source = os.path.join(self.root, name)
+            Image.new('RGB', (50, 40)).save(source)
+            archived = os.path.join(self.archive, name)
+            with open(archived, 'wb') as f:
+                f.write(partial)
+            self.journal.add({'file': archived, 'format': 'PNG', 'hash': None, 'phash': None},
+                             ['journal-test'], source)
+
+        mercury.dispatcher.replay(self.config)
+        self.assertEqual(sorted(queued), [os.path.join(self.root, 'a.png'),
+                                          os.path.join(self.root, 'b.png')])
+        self.assertEqual(self._rows(), [])
+        self.assertEqual(os.listdir(self.archive), [])
+
+    def test_source_is_cleared_once_moved(self):
+        path = os.path.join(self.root, 'a.png')
+        Image.new('RGB', (50, 40)).save(path)
+        mercury.dispatcher.dispatch(self.config, path)
+        archived = os.path.join(self.archive, 'a.png')
+        source = self.config['db'].connect().execute('select source from jobs').fetchall()
+        self.assertEqual(source, [(None,)])
+        self.assertTrue(os.path.exists(archived))
+
+
+class InFlightDedupTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        archive = os.path.join(self.root, 'archive')
+        os.mkdir(archive)
+        self.config = {'services': {'dedup-test': None}, 'dedup': True,
+                       'watched_folder': self.root, 'archive_folder': archive,
+                       'database_file': os.path.join(self.root, 'test.sqlite')}
+        self.config['db'] = mercury.database.db(self.config)
+        self.journal = self.config['journal'] = mercury.database.Journal(self.config['db'])
+        mercury.services.registry['dedup-test'] = object()
+        self.addCleanup(mercury.services.registry.pop, 'dedup-test')
+
+        self.submitted = []
+
+        class Worker(object):
+            services = ['dedup-test']
+
+            def put(worker, job):
+                self.submitted.append(job)
+                mercury.dispatcher.budget.release(job['cost'])
+                mercury.dispatcher.pending.done()
+        original = mercury.dispatcher.resizeworkers
+        mercury.dispatcher.resizeworkers = [Worker()]
+        self.addCleanup(setattr, mercury.dispatcher, 'resizeworkers', original)
+
+    def _copy(self, name):
+        path = os.path.join(self.root, name)
+        Image.new('RGB', (50, 40), (10, 20, 30)).save(path, 'PNG')
+        count = len(self.submitted)
+        mercury.dispatcher.dispatch(self.config, path)
+        if len(self.submitted) > count:
+            return self.submitted[-1]
+
+    def test_copies_in_flight_go_once(self):
+        first = self._copy('a.png')
+        self.assertEqual(first['services'], ['dedup-test'])
+        self.assertEqual(self._copy('copy.png'), None)
+
+        # Once the first copy has failed another is free to try
+        self.journal.failed(first, 'dedup-test')
+        self.journal.flush()
+        self.assertEqual(self._copy('again.png')['services'], ['dedup-test'])
+
+
+if __name__ == '__main__':
+    unittest.main()
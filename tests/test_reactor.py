@@ -0,0 +1,128 @@
+'''
+test_reactor.py
+Requests sent through the reactor, alone and for the upload engine.
+
+    python -m unittest discover tests
+'''
+import BaseHTTPServer
+import os
+import SocketServer
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mercury.dispatcher
+import mercury.reactor
+import mercury.services
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    delay = 0
+    active = 0
+    most = 0
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with server.lock:
+            server.active += 1
+            server.most = max(server.most, server.active)
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Service(object):
+    '''Stands in for a service whose requests are sent for it.'''
+    formats = ('JPEG',)
+
+    def __init__(self, url):
+        self.url = url
+
+    def upload(self, config, path, *args, **kwargs):
+        raise AssertionError('uploaded on a thread')
+
+    def request(self, config, filename, f):
+        return self.url, {'Content-Type': 'image/jpeg'}, f.read(), None
+
+    def response(self, config, resp, token):
+        return {'link': resp.content}
+
+
+class ReactorTest(unittest.TestCase):
+    def setUp(self):
+        self.server = _Server(('127.0.0.1', 0), _Handler)
+        self.server.lock = threading.Lock()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%i/upload' % self.server.server_address[1]
+
+    def _wait(self, results, count):
+        deadline = time.time() + 10
+        while len(results) < count and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_request_gets_response(self):
+        reactor = mercury.reactor.Reactor(5)
+        results = []
+        reactor.request('POST', self.url, {}, 'hello', lambda resp, error: results.append((resp, error)))
+        self._wait(results, 1)
+        resp, error = results[0]
+        self.assertEqual(error, None)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, 'hello')
+
+    def test_stalled_request_times_out(self):
+        self.server.delay = 2
+        reactor = mercury.reactor.Reactor(0.3)
+        results = []
+        reactor.request('POST', self.url, {}, 'hello', lambda resp, error: results.append((resp, error)))
+        self._wait(results, 1)
+        resp, error = results[0]
+        self.assertEqual(resp, None)
+        self.assertTrue(isinstance(error, mercury.reactor.requests.Timeout))
+
+    def test_engine_uploads_past_its_threads(self):
+        name = 'test-reactor'
+        self.server.delay = 0.5
+        mercury.services.registry[name] = _Service(self.url)
+        self.addCleanup(mercury.services.registry.pop, name)
+        config = {'services': {name: {'concurrency': 4}}, 'dedup': False, 'http_timeout': 5}
+        engine = mercury.dispatcher.UploadEngine(config, 1)
+        queue = engine.add(name, 4)
+
+        before = mercury.dispatcher.pending.count
+        for n in range(4):
+            job = {'file': '/nonexistent/%i.jpg' % n, 'format': 'JPEG', 'cost': 0, 'services': [name],
+                   'hash': None, 'phash': None, 'priority': 0}
+            mercury.dispatcher.pending.add()
+            queue.put(mercury.dispatcher.Upload('image', 'JPEG', name, job, 0, False, None))
+
+        deadline = time.time() + 10
+        while mercury.dispatcher.pending.count > before and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(mercury.dispatcher.pending.count, before)
+        # One thread, yet all four were waiting on the server together
+        self.assertEqual(self.server.most, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,258 @@
+'''
+test_resilience.py
+Circuit breaker and error handling as seen through UploadWorker.
+
+    python -m unittest discover tests
+'''
+import os
+import Queue
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests.adapters
+
+import mercury.dedup
+import mercury.dispatcher
+import mercury.resilience
+import mercury.services
+import mercury.services.imgur
+import mercury.sessions
+
+
+class _Service(object):
+    '''Stands in for a service, failing with whatever errors is given in turn.'''
+    formats = ('JPEG',)
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def upload(self, config, path, *args, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return {'link': 'http://example.com/%i' % self.calls}
+
+
+class _Queue(object):
+    def __init__(self):
+        self.items = []
+
+    def put(self, item):
+        self.items.append(item)
+
+
+class BreakerProbeTest(unittest.TestCase):
+    reset = 0.05
+
+    def _worker(self, name, errors):
+        service = mercury.services.registry[name] = _Service(errors)
+        self.addCleanup(mercury.services.registry.pop, name)
+        config = {'services': {name: None}, 'dedup': False,
+                  'breaker_threshold': 1, 'breaker_reset': self.reset, 'retry_limit': 1}
+        worker = mercury.dispatcher.UploadWorker(config, name, _Queue(), thread=False)
+        return worker, service
+
+    def _item(self, name, n):
+        job = {'file': '/nonexistent/%i.jpg' % n, 'format': 'JPEG', 'cost': 0, 'services': [name],
+               'hash': None, 'phash': None, 'priority': 0}
+        mercury.dispatcher.pending.add()
+        return mercury.dispatcher.Upload(None, 'JPEG', name, job, 0, False, None)
+
+    def test_permanent_error_on_probe_doesnt_wedge_breaker(self):
+        name = 'test-probe-permanent'
+        worker, service = self._worker(name, [
+            mercury.resilience.TransientError('down'),
+            mercury.resilience.PermanentError('bad file'),
+        ])
+        breaker = mercury.resilience.breaker(worker._config, name)
+
+        worker.handle(self._item(name, 1))
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # The probe fails in a way that says nothing about the service
+        time.sleep(self.reset * 2)
+        worker.handle(self._item(name, 2))
+        self.assertEqual(service.calls, 2)
+        self.assertEqual(breaker.state, breaker.OPEN)
+
+        # The next item gets its own probe rather than being shed forever
+        time.sleep(self.reset * 2)
+        worker.handle(self._item(name, 3))
+        self.assertEqual(service.calls, 3)
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+    def test_permanent_error_when_closed_doesnt_open(self):
+        name = 'test-closed-permanent'
+        worker, service = self._worker(name, [mercury.resilience.PermanentError('bad file')])
+        breaker = mercury.resilience.breaker(worker._config, name)
+        worker.handle(self._item(name, 1))
+        self.assertEqual(breaker.state, breaker.CLOSED)
+
+
+class ParkedItemTest(unittest.TestCase):
+    def test_retry_spills_data_and_gives_back_budget(self):
+        name = 'test-spill'
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, True)
+        service = mercury.services.registry[name] = _Service([mercury.resilience.TransientError('down')])
+        self.addCleanup(mercury.services.registry.pop, name)
+        config = {'services': {name: None}, 'dedup': False, 'tmp': tmp,
+                  'retry_delay': 0.01, 'breaker_threshold': 10}
+        queue = _Queue()
+        worker = mercury.dispatcher.UploadWorker(config, name, queue, thread=False)
+
+        budget = mercury.dispatcher.budget
+        before = budget.used
+        data = 'x' * 1000
+        budget.charge(len(data))
+        mercury.dispatcher.pending.add()
+        job = {'file': '/nonexistent/1.jpg', 'format': 'JPEG', 'cost': 0, 'services': [name],
+               'hash': None, 'phash': None, 'priority': 0}
+        worker.handle(mercury.dispatcher.Upload(data, 'JPEG', name, job, 0, True, None))
+        self.assertEqual(budget.used, before)
+
+        deadline = time.time() + 5
+        while not queue.items and time.time() < deadline:
+            time.sleep(0.01)
+        item = queue.items.pop()
+        self.assertEqual(item.data, None)
+        self.assertEqual(item.attempt, 1)
+        with open(item.spill, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+        worker.handle(item)
+        self.assertEqual(service.calls, 2)
+        self.assertFalse(os.path.exists(item.spill))
+        self.assertEqual(budget.used, before)
+
+
+class UploadResultTest(unittest.TestCase):
+    def test_succeeded(self):
+        self.assertTrue(mercury.resilience.succeeded({'id': 1}))
+        self.assertFalse(mercury.resilience.succeeded(None))
+        self.assertFalse(mercury.resilience.succeeded({'meta': {'status': 400, 'msg': 'Bad Request'}}))
+        self.assertFalse(mercury.resilience.succeeded({'status': 'error', 'error': 'invalid_request'}))
+        self.assertFalse(mercury.resilience.succeeded({'meta': {'status': 'Bad Request'}}))
+
+    def test_error_payload_isnt_recorded(self):
+        name = 'test-error-payload'
+        recorded = []
+        original = mercury.dedup.record
+        mercury.dedup.record = lambda *args: recorded.append(args)
+        self.addCleanup(setattr, mercury.dedup, 'record', original)
+
+        class _Errors(_Service):
+            def upload(self, config, path, *args, **kwargs):
+                self.calls += 1
+                return {'meta': {'status': 400, 'msg': 'Bad Request'}, 'response': []}
+        service = mercury.services.registry[name] = _Errors([])
+        self.addCleanup(mercury.services.registry.pop, name)
+        worker = mercury.dispatcher.UploadWorker({'services': {name: None}}, name, _Queue(), thread=False)
+        job = {'file': '/nonexistent/1.jpg', 'format': 'JPEG', 'cost': 0, 'services': [name],
+               'hash': 'abc', 'phash': None, 'priority': 0}
+        mercury.dispatcher.pending.add()
+        worker.handle(mercury.dispatcher.Upload(None, 'JPEG', name, job, 0, False, None))
+        self.assertEqual(service.calls, 1)
+        self.assertEqual(recorded, [])
+
+
+class UploadWorkerErrorTest(unittest.TestCase):
+    def test_unexpected_error_doesnt_end_the_thread(self):
+        name = 'test-worker-error'
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, True)
+
+        class _Flaky(_Service):
+            def upload(self, config, path, *args, **kwargs):
+                self.calls += 1
+                if self.calls == 1:
+                    return {'meta': {'status': 'oops'}}
+                return {'id': self.calls}
+        service = mercury.services.registry[name] = _Flaky([])
+        self.addCleanup(mercury.services.registry.pop, name)
+        failed = []
+
+        class _Journal(object):
+            def failed(self, job, service):
+                failed.append(job['file'])
+
+            def done(self, job, service):
+                pass
+        config = {'services': {name: None}, 'dedup': False, 'tmp': tmp, 'journal': _Journal()}
+        original = mercury.resilience.succeeded
+        # Something in handle() outside the upload itself blowing up
+        mercury.resilience.succeeded = lambda result: 'meta' not in result or int(result['meta']['status'])
+        self.addCleanup(setattr, mercury.resilience, 'succeeded', original)
+
+        queue = Queue.Queue()
+        mercury.dispatcher.UploadWorker(config, name, queue)
+        before = mercury.dispatcher.pending.count
+        for n in (1, 2):
+            job = {'file': '/nonexistent/%i.jpg' % n, 'format': 'JPEG', 'cost': 0, 'services': [name],
+                   'hash': None, 'phash': None, 'priority': 0}
+            mercury.dispatcher.pending.add()
+            queue.put(mercury.dispatcher.Upload(None, 'JPEG', name, job, 0, False, None))
+
+        deadline = time.time() + 5
+        while mercury.dispatcher.pending.count > before and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(service.calls, 2)
+        self.assertEqual(mercury.dispatcher.pending.count, before)
+        self.assertEqual(failed, ['/nonexistent/1.jpg'])
+
+    def test_missing_spill_is_given_up_on(self):
+        name = 'test-missing-spill'
+        service = mercury.services.registry[name] = _Service([])
+        self.addCleanup(mercury.services.registry.pop, name)
+        worker = mercury.dispatcher.UploadWorker({'services': {name: None}, 'dedup': False},
+                                                 name, _Queue(), thread=False)
+        job = {'file': '/nonexistent/1.jpg', 'format': 'JPEG', 'cost': 0, 'services': [name],
+               'hash': None, 'phash': None, 'priority': 0}
+        before = mercury.dispatcher.pending.count
+        used = mercury.dispatcher.budget.used
+        mercury.dispatcher.pending.add()
+        worker.handle(mercury.dispatcher.Upload(None, 'JPEG', name, job, 1, False, '/nonexistent/spill'))
+        self.assertEqual(service.calls, 0)
+        self.assertEqual(mercury.dispatcher.pending.count, before)
+        self.assertEqual(mercury.dispatcher.budget.used, used)
+
+
+class ServiceErrorTest(unittest.TestCase):
+    def test_imgur_error_page_is_transient(self):
+        class _Tokens(object):
+            def get(self):
+                pass
+
+        class _Api(object):
+            def upload_image(self, path=None, url=None):
+                raise ValueError('No JSON object could be decoded')
+        config = {'imgur': {'tokens': _Tokens(), 'api_object': _Api()}}
+        try:
+            mercury.services.imgur.upload(config, '/nonexistent/1.jpg')
+        except Exception as e:
+            self.assertEqual(mercury.resilience.classify(e), mercury.resilience.TRANSIENT)
+        else:
+            self.fail('upload returned')
+
+    def test_sessions_time_out(self):
+        sent = []
+        original = requests.adapters.HTTPAdapter.send
+        requests.adapters.HTTPAdapter.send = lambda self, request, **kwargs: sent.append(kwargs['timeout'])
+        self.addCleanup(setattr, requests.adapters.HTTPAdapter, 'send', original)
+        self.addCleanup(mercury.sessions.close)
+
+        session = mercury.sessions.session({'http_timeout': 5}, 'test-timeout')
+        adapter = session.get_adapter('https://example.com/')
+        adapter.send(None)
+        adapter.send(None, timeout=1)
+        self.assertEqual(sent, [5.0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()
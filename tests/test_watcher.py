@@ -0,0 +1,60 @@
+'''
+test_watcher.py
+When the stabilizer hands files on to be dispatched.
+
+    python -m unittest discover tests
+'''
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mercury.watcher
+
+
+class StabilizerTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root, True)
+        self.ready = []
+        self.stabilizer = mercury.watcher.Stabilizer(
+            {'quiet_period': 30, 'close_grace': 0.1}, self.ready.append)
+        self.addCleanup(self.stabilizer.stop)
+
+    def _write(self, name):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write('x' * 100)
+        return path
+
+    def test_temporary_file_renamed_after_close_isnt_handed_on(self):
+        part = self._write('b.jpg.part')
+        self.stabilizer.track(part)
+        self.stabilizer.closed(part)
+        # As the watcher does for the rename
+        final = os.path.join(self.root, 'b.jpg')
+        os.rename(part, final)
+        self.stabilizer.forget(part)
+        self.stabilizer.ready(final)
+
+        time.sleep(0.5)
+        self.assertEqual(self.ready, [final])
+
+    def test_closed_file_is_handed_on_after_the_grace_period(self):
+        path = self._write('a.jpg')
+        self.stabilizer.track(path)
+        self.stabilizer.closed(path)
+        self.assertEqual(self.ready, [])
+
+        deadline = time.time() + 5
+        while not self.ready and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(self.ready, [path])
+
+
+if __name__ == '__main__':
+    unittest.main()